@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+''' Benchmarks of the log tools (tailoop, multiple_parser) on synthetic loopchain logs.
+
+    bench_logtools.py generate --lines 1000000 --output /tmp/bench.log
+    bench_logtools.py run --logfile /tmp/bench.log --output result.json
+    bench_logtools.py run --logfile /tmp/bench.log --compare result.json
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import multiple_parser
+import tailoop
+
+BENCH_VERSION = 1
+
+messages = [
+    ("rest_client.py", "call_async", 146, "REST call async complete method_name(node_getBlockByHeight)"),
+    ("block_sync.py", "_request_completed", 338, "block_height({height}) received"),
+    ("block_sync.py", "_citizen_request", 373, "request heights: odict_keys([{height}]), size: 1"),
+    ("block_sync.py", "_block_sync", 477, "try add block height: {height}"),
+    ("block_sync.py", "_block_sync", 484, "max_height: {height}, max_block_height: {height}, unconfirmed_block_height: -1, confirm_info count: 22"),
+    ("block_sync.py", "_add_block_by_sync", 582, "height({height}) hash(Hash32(0x{hash}))"),
+    ("blockchain.py", "prevent_next_block_mismatch", 732, "next_height: {height}"),
+    ("channel_inner_service.py", "add_tx", 512, "add tx(0x{hash}) to the pool, size: 4"),
+    ("broadcast_scheduler.py", "_send_message", 233, "send message to target(10.{ip}.3.7:7100)"),
+]
+address_messages = [
+    ("epoch.py", "set_epoch_leader", 86, "height({height}) leader_id({address})"),
+    ("consensus_siever.py", "_vote", 201, "vote from peer({address}) round({round})"),
+    ("peer_manager.py", "update_peer", 90, "peer {address} status(`connected') target(/app/prep/data/peer.json)"),
+]
+errors = [
+    ("message_queue.py", "_on_message", 120, "Exception in message handler"),
+    ("consensus_siever.py", "_consensus", 310, "Fail to make block height({height})"),
+]
+tracebacks = [
+    ["Traceback (most recent call last):",
+     '  File "/usr/local/lib/python3.7/site-packages/loopchain/channel/channel_service.py", line 210, in _run',
+     "    await self.__inner_service.connect(conf.AMQP_CONNECTION_ATTEMPTS, conf.AMQP_RETRY_DELAY, exclusive=True)",
+     "ConnectionResetError: [Errno 104] Connection reset by peer"],
+    ["Traceback (most recent call last):",
+     '  File "/usr/local/lib/python3.7/site-packages/loopchain/blockchain/blockchain.py", line 732, in add_block',
+     "    raise BlockchainError(f\"Invalid block height\")",
+     "loopchain.blockchain.exception.BlockchainError: Invalid block height"],
+]
+
+
+def make_peers(count, rnd):
+    return ["hx" + "%040x" % rnd.getrandbits(160) for _ in range(count)]
+
+
+def generate_log(output, lines=100000, size=None, peers=None, error_ratio=0.01, traceback_ratio=0.5,
+                 vote_ratio=0.02, address_density=0.1, seed=1):
+    ''' Writes a synthetic loopchain log to the file object `output` until
+        `lines` lines or `size` bytes are written, returns the line count.
+
+    error_ratio: ERROR lines per line, traceback_ratio of them followed by a stack trace
+    vote_ratio: `Votes : Votes` blocks per line, with height/round progression
+    address_density: lines carrying a full P-Rep address
+    '''
+    rnd = random.Random(seed)
+    peers = peers or make_peers(22, rnd)
+    local_peer = peers[0][:8]
+    timestamp = datetime(2020, 12, 30, 0, 0, 0)
+    height = 743000
+    round_number = 0
+    written = 0
+    size_written = 0
+    buffer = []
+
+    def emit(level, location, message):
+        text = (f"{timestamp:%Y-%m-%d %H:%M:%S},{timestamp.microsecond // 1000:03d} 588 140200854329088 {local_peer} "
+                f"icon_dex {level:<8} [{location[0]}:{location[1]}:{location[2]}] {message}")
+        buffer.append(text)
+
+    while (size_written < size) if size else (written < lines):
+        timestamp += timedelta(microseconds=rnd.randint(0, 20000))
+        draw = rnd.random()
+        fields = {"height": height, "round": round_number, "hash": "%064x" % rnd.getrandbits(256),
+                  "ip": rnd.randint(0, 255), "address": rnd.choice(peers)}
+        if draw < vote_ratio:
+            if rnd.random() < 0.7:
+                height += 1
+                round_number = 0
+                fields["height"] = height
+                emit("DEBUG", address_messages[0], address_messages[0][3].format(**fields))
+            else:
+                round_number += 1
+            emit("DEBUG", ("epoch.py", "new_round", 60), f"new round {round_number}, 0")
+            emit("DEBUG", ("votes.py", "get_summary", 95), "Votes : Votes")
+            agreed = rnd.randint(0, len(peers))
+            buffer.extend([
+                f"Height    : {height}",
+                f"Round     : {round_number}",
+                f"True      : {agreed}/{len(peers)}",
+                f"Empty     : {len(peers) - agreed}/{len(peers)}",
+                f"Quorum    : {len(peers) * 2 // 3 + 1}",
+                f"Result    : {agreed > len(peers) * 2 // 3}",
+            ])
+        elif draw < vote_ratio + error_ratio:
+            location = rnd.choice(errors)
+            emit("ERROR", location, location[3].format(**fields))
+            if rnd.random() < traceback_ratio:
+                buffer.extend(rnd.choice(tracebacks))
+        elif draw < vote_ratio + error_ratio + address_density:
+            location = rnd.choice(address_messages)
+            emit(rnd.choice(("DEBUG", "DEBUG", "INFO")), location, location[3].format(**fields))
+        else:
+            location = rnd.choice(messages)
+            emit(rnd.choice(("DEBUG", "DEBUG", "DEBUG", "INFO", "WARNING")), location, location[3].format(**fields))
+
+        if len(buffer) >= 1024:
+            text = "\n".join(buffer) + "\n"
+            output.write(text)
+            written += len(buffer)
+            size_written += len(text)
+            buffer = []
+    if buffer:
+        output.write("\n".join(buffer) + "\n")
+        written += len(buffer)
+    return written
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda fraction: round(samples[min(int(len(samples) * fraction), len(samples) - 1)] * 1e6, 2)
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(samples[-1] * 1e6, 2)}
+
+
+def _per_line(function):
+    ''' A benchmark calling function(line) for every line, with latency samples '''
+    def _benchmark(lines, latency_lines):
+        start = time.perf_counter()
+        for line in lines:
+            function(line)
+        seconds = time.perf_counter() - start
+        clock = time.perf_counter
+        samples = []
+        for line in lines[:latency_lines]:
+            begin = clock()
+            function(line)
+            samples.append(clock() - begin)
+        return seconds, percentiles(samples)
+    return _benchmark
+
+
+def _streaming(function):
+    ''' A benchmark consuming function(lines) as one pass '''
+    def _benchmark(lines, latency_lines):
+        start = time.perf_counter()
+        for _ in function(iter(lines)):
+            pass
+        return time.perf_counter() - start, {}
+    return _benchmark
+
+
+def _rule_loading(cold, loads=50):
+    ''' A benchmark of load_rules() on a private cache directory, emptied
+        before every load when `cold` and filled once beforehand otherwise.
+    '''
+    def _benchmark():
+        cache_dir = tempfile.mkdtemp(prefix="bench-rules-")
+        clock = time.perf_counter
+        samples = []
+        try:
+            if not cold:
+                tailoop.load_rules(tailoop.REGEX_DATA, cache_dir=cache_dir)
+            for _ in range(loads):
+                if cold:
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                begin = clock()
+                tailoop.load_rules(tailoop.REGEX_DATA, cache_dir=cache_dir)
+                samples.append(clock() - begin)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        return samples
+    return _benchmark
+
+
+rule_benchmarks = {
+    "rules_cold": _rule_loading(cold=True),
+    "rules_warm": _rule_loading(cold=False),
+}
+
+
+def _regex_parse_line(line):
+    ''' The full loopchain_line regex, the baseline of parse_line '''
+    match = multiple_parser.loopchain_line.match(line)
+    return match.groupdict() if match else None
+
+
+def make_benchmarks(peers):
+    prep_address = {address: f"prep-{index}" for index, address in enumerate(peers)}
+    address_index = tailoop.AddressIndex(prep_address)
+    # the uncached parser, rule loading is measured by rule_benchmarks without touching ~/.cache
+    colorizer = tailoop.Colorizer(tailoop.getREGEX(tailoop.REGEX_DATA), actions=tailoop.ActionCollector())
+    return {
+        "address": _per_line(address_index.replace),
+        "colorize": _per_line(colorizer.colorize),
+        "render": _per_line(lambda line: tailoop.render_line(line, address_index, colorizer)),
+        "parse_line": _per_line(multiple_parser.parse_loopchain_line),
+        "parse_line_regex": _per_line(_regex_parse_line),
+        "multiline": _streaming(lambda lines: multiple_parser.MultilineParser(multiple_parser.loopchain_line).parse(lines)),
+        "stream_metrics": _streaming(multiple_parser.stream_metrics),
+        "votes": _streaming(lambda lines: multiple_parser.VoteTimeline().parse(lines)),
+    }
+
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_rule_child(name, repeat, queue):
+    try:
+        samples = min((rule_benchmarks[name]() for _ in range(repeat)), key=sum)
+        queue.put({
+            "name": name,
+            "loads": len(samples),
+            "seconds": round(sum(samples), 6),
+            "ms_per_load": round(sum(samples) / len(samples) * 1000, 3),
+            "latency_us": percentiles(samples),
+        })
+    except Exception as e:
+        queue.put({"name": name, "error": f"{type(e).__name__}: {e}"})
+
+
+def _run_child(name, logfile, peers, repeat, latency_lines, queue):
+    try:
+        with open(logfile, encoding="utf-8", errors="replace") as f:
+            lines = [line.rstrip("\n") for line in f]
+        benchmark = make_benchmarks(peers)[name]
+        rss_before = max_rss_kb()
+        timings = [benchmark(lines, latency_lines if index == 0 else 0) for index in range(repeat)]
+        seconds = min(seconds for seconds, _ in timings)
+        nbytes = sum(len(line) + 1 for line in lines)
+        queue.put({
+            "name": name,
+            "lines": len(lines),
+            "bytes": nbytes,
+            "seconds": round(seconds, 6),
+            "lines_per_sec": round(len(lines) / seconds, 1),
+            "mbytes_per_sec": round(nbytes / seconds / 1024 / 1024, 3),
+            "latency_us": timings[0][1],
+            "rss_growth_kb": max_rss_kb() - rss_before,
+        })
+    except Exception as e:
+        queue.put({"name": name, "error": f"{type(e).__name__}: {e}"})
+
+
+def run_benchmarks(logfile, peers, names, repeat=3, latency_lines=20000):
+    ''' Runs every benchmark in its own process, so the memory growth of
+        one does not hide that of the next, and returns the results.
+    '''
+    results = []
+    for name in names:
+        queue = multiprocessing.Queue()
+        if name in rule_benchmarks:
+            process = multiprocessing.Process(target=_run_rule_child, args=(name, repeat, queue))
+        else:
+            process = multiprocessing.Process(target=_run_child, args=(name, logfile, peers, repeat, latency_lines, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        results.append(result)
+        print_result(result)
+    return results
+
+
+def print_result(result, baseline=None):
+    if "error" in result:
+        print(f"{result['name']:<16} ERROR {result['error']}")
+        return
+    if "loads" in result:
+        line = (f"{result['name']:<16} {result['ms_per_load']:>9.3f} ms/load {result['loads']:>6} loads "
+                f"p50 {result['latency_us']['p50']}us p99 {result['latency_us']['p99']}us")
+        if baseline and baseline.get("ms_per_load"):
+            line += f"  ({(baseline['ms_per_load'] / result['ms_per_load'] - 1) * 100:+.1f}%)"
+        print(line)
+        return
+    line = (f"{result['name']:<16} {result['lines_per_sec']:>12,.0f} lines/s {result['mbytes_per_sec']:>9.2f} MB/s "
+            f"{result['seconds']:>9.3f}s  rss +{result['rss_growth_kb'] // 1024} MB")
+    if result.get("latency_us"):
+        line += f"  p50 {result['latency_us']['p50']}us p99 {result['latency_us']['p99']}us"
+    if baseline and baseline.get("lines_per_sec"):
+        change = (result["lines_per_sec"] / baseline["lines_per_sec"] - 1) * 100
+        line += f"  ({change:+.1f}%)"
+    print(line)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks of tailoop and multiple_parser on synthetic loopchain logs')
+    parser.add_argument('command', nargs='?', help='generate, run', default="run")
+    parser.add_argument('--logfile', metavar='logfile', help=f'log file to benchmark, generated when missing', default="/tmp/bench_loopchain.log")
+    parser.add_argument('--output', metavar='output', help=f'generate: log file to write, run: JSON result file', default=None)
+    parser.add_argument('--lines', metavar='lines', type=int, help=f'lines to generate', default=200000)
+    parser.add_argument('--size', metavar='size', type=int, help=f'MB to generate instead of --lines', default=None)
+    parser.add_argument('--peers', metavar='peers', type=int, help=f'number of P-Rep addresses', default=22)
+    parser.add_argument('--error-ratio', metavar='error-ratio', type=float, help=f'ERROR lines per line', default=0.01)
+    parser.add_argument('--traceback-ratio', metavar='traceback-ratio', type=float, help=f'ERROR lines followed by a stack trace', default=0.5)
+    parser.add_argument('--vote-ratio', metavar='vote-ratio', type=float, help=f'vote blocks per line', default=0.02)
+    parser.add_argument('--address-density', metavar='address-density', type=float, help=f'lines with a P-Rep address', default=0.1)
+    parser.add_argument('--seed', metavar='seed', type=int, help=f'random seed', default=1)
+    parser.add_argument('--bench', metavar='bench', nargs='+', help=f'benchmarks to run (default all)', default=None)
+    parser.add_argument('--repeat', metavar='repeat', type=int, help=f'runs per benchmark, the fastest one counts', default=3)
+    parser.add_argument('--latency-lines', metavar='latency-lines', type=int, help=f'lines timed one by one for the latency percentiles', default=20000)
+    parser.add_argument('--compare', metavar='compare', help=f'JSON result file of another version to compare with', default=None)
+    return parser
+
+
+def generate(filename):
+    start_time = time.monotonic()
+    with open(filename, "w") as f:
+        count = generate_log(
+            f, lines=args.lines, size=args.size * 1024 * 1024 if args.size else None,
+            peers=make_peers(args.peers, random.Random(args.seed)), error_ratio=args.error_ratio,
+            traceback_ratio=args.traceback_ratio, vote_ratio=args.vote_ratio,
+            address_density=args.address_density, seed=args.seed,
+        )
+    print(f"[generate] {count} lines, {os.path.getsize(filename) / 1024 / 1024:.1f} MB, "
+          f"{time.monotonic() - start_time:.1f}s -> {filename}")
+
+
+def main():
+    if args.command == "generate":
+        generate(args.output or args.logfile)
+        return
+
+    if not os.path.exists(args.logfile):
+        generate(args.logfile)
+    peers = make_peers(args.peers, random.Random(args.seed))
+    names = args.bench or list(make_benchmarks(peers)) + list(rule_benchmarks)
+    results = run_benchmarks(args.logfile, peers, names, args.repeat, args.latency_lines)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {result["name"]: result for result in json.load(f)["results"]}
+        print(f"\ncompared with {args.compare}")
+        for result in results:
+            print_result(result, baseline.get(result["name"]))
+
+    if args.output:
+        report = {
+            "version": BENCH_VERSION,
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "logfile": {"path": args.logfile, "bytes": os.path.getsize(args.logfile), "peers": args.peers, "seed": args.seed},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"[run] results -> {args.output}")
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    args = parser.parse_args()
+    main()
@@ -1,6 +1,23 @@
 #!/usr/bin/env python3
 import re, sys
+import os
+import io
+import time
+import json
+import csv
+import mmap
+import array
+import bisect
+import glob
+import gzip
+import bz2
+import shutil
+import heapq
 from datetime import datetime
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 import argparse
 import subprocess
 import calendar
@@ -8,6 +25,46 @@ import calendar
 
 first_line = re.compile(r'^(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) \| (?P<severity>[^ ]*) \| (?P<logger>[^ ]*) \| (?P<location>[^ ]*) \|.*$')
 stack_trace_end = re.compile(r'^(?P<exception>[a-zA-Z]\w*)(:.*)?$')
+loopchain_head = re.compile(r'(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) (\d+) (\d+) (\w{8}) (\w+) ([^ ]\w+)( +)\[').match
+loopchain_line = re.compile(r'^(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) (?P<pid>\d+) (?P<thread_id>\d+) (?P<peer_id>\w{8}) '
+                            r'(?P<channel>\w+) (?P<level>[^ ]\w+) (\s+) \[(?P<file>.*):(?P<function>.*):(?P<line>.*)\] (?P<message>.*)$')
+
+
+def parse_loopchain_line(line):
+    ''' Same result as loopchain_line.match(line).groupdict(), or None.
+
+    Lines that do not start with the `YYYY-MM-DD HH:MM:SS,mmm` prefix
+    (continuation lines, stack traces) are rejected with fixed-offset
+    checks. Otherwise the space separated head of the line is matched
+    without backtracking and the `[file:function:line] message` part is
+    split on its separators. Anything irregular falls back to the regex.
+
+    Measured on a synthetic loopchain log (bench_logtools.py parse_line
+    against parse_line_regex) this is about 2x the throughput of the
+    regex per line and about 1.6x end to end for `cat`, short of the 3x
+    that was aimed for. A split/str-method parser and a single anchored
+    regex were both slower than this head regex plus partition.
+    '''
+    if line[19:20] != ',' or line[4:5] != '-' or line[13:14] != ':':
+        return None
+    head = loopchain_head(line)
+    if head:
+        timestamp, pid, thread_id, peer_id, channel, level, gap = head.groups()
+        if len(gap) < 3:
+            # the level has to be followed by 3 or more spaces, e.g. "WARNING [" never matches
+            return None
+        location, separator, message = line[head.end():].partition('] ')
+        location = location.rsplit(':', 2)
+        if separator and len(location) == 3 and '] ' not in message and '\n' not in line:
+            file, function, line_number = location
+            return {
+                'timestamp': timestamp, 'pid': pid, 'thread_id': thread_id, 'peer_id': peer_id,
+                'channel': channel, 'level': level, 'file': file, 'function': function,
+                'line': line_number, 'message': message,
+            }
+
+    match = loopchain_line.match(line)
+    return match.groupdict() if match else None
 
 
 def parse_date(date: str):
@@ -48,15 +105,23 @@ class MultilineParser(object):
       * Line looks like end of the stack trace (emits point, resets state)
     '''
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, line_regex=None, *args, **kwargs):
         self.state = self.looking_for_start
         self.data = {}
+        self.line_regex = line_regex
 
 
     def parse_line(self, line):
         'Entry point to the log parser'
         return self.state(line)
 
+    def parse(self, lines):
+        'Streaming entry point, yields the metric points of an iterable of lines'
+        for line in lines:
+            point = self.state(line.rstrip('\r\n'))
+            if point is not None:
+                yield point
+
     def looking_for_start(self, line):
         ''' Initial state of the parser. Will match lines starting with
             a timestamp. If it sees that the log message was of ERROR
@@ -64,12 +129,18 @@ class MultilineParser(object):
             otherwise, return a metric point for the line.
         '''
         global first_line
-        match = first_line.match(line)
-        if match:
-            data = match.groupdict()
+        if self.line_regex is loopchain_line:
+            data = parse_loopchain_line(line)
+        else:
+            match = (self.line_regex or first_line).match(line)
+            data = match.groupdict() if match else None
+        if data:
+            # the loopchain format names these fields level and channel
+            data.setdefault('severity', data.get('level'))
+            data.setdefault('logger', data.get('channel'))
             severity = data.get('severity')
             if severity == 'ERROR':
-                self.data = match.groupdict()
+                self.data = data
                 self.state = self.find_stack_trace_start
             elif severity is not None:
                 return (
@@ -87,7 +158,7 @@ class MultilineParser(object):
         if line.startswith('Traceback'):
             self.state = self.find_stack_trace_end
         else:
-            self.looking_for_start(line)
+            return self.looking_for_start(line)
 
     def find_stack_trace_end(self, line):
         ''' Find the end of the stack trace. If found, return a metric point
@@ -110,14 +181,740 @@ class MultilineParser(object):
             self.state = self.looking_for_start
             return output
         else:
-            self.looking_for_start(line)
+            return self.looking_for_start(line)
+
+
+class MetricBatcher(object):
+    ''' Aggregates the metric points of MultilineParser into one counter per
+        (metric, tags) and time bucket.
+
+    `add()` returns the points of the buckets that were closed by the new
+    point, `flush()` returns everything still open. Only the newest
+    `open_buckets` buckets are kept, so memory does not depend on the size
+    of the log. A point older than every open bucket is counted into a new
+    batch of its own bucket instead of being dropped.
+    '''
+
+    def __init__(self, bucket=60, open_buckets=2):
+        self.bucket = bucket
+        self.open_buckets = open_buckets
+        self.buckets = {}
+        self.points = 0
+
+    def add(self, point):
+        name, timestamp, value, attributes = point
+        bucket = int(timestamp.timestamp()) // self.bucket * self.bucket
+        key = (name, tuple(attributes.get('tags', [])))
+        counters = self.buckets.get(bucket)
+        if counters is None:
+            counters = self.buckets[bucket] = {}
+        counters[key] = counters.get(key, 0) + value
+        self.points += 1
+        if len(self.buckets) > self.open_buckets:
+            return self._close(sorted(self.buckets)[:-self.open_buckets])
+        return []
+
+    def flush(self):
+        return self._close(sorted(self.buckets))
+
+    def _close(self, buckets):
+        output = []
+        for bucket in buckets:
+            for (name, tags), value in self.buckets.pop(bucket).items():
+                attributes = {'metric_type': 'counter'}
+                if tags:
+                    attributes['tags'] = list(tags)
+                output.append((name, datetime.fromtimestamp(bucket), value, attributes))
+        return output
+
+
+class ThroughputStats(object):
+    ''' Counts lines and bytes passing through `wrap()` and reports the
+        throughput to stderr every `interval` seconds and at the end.
+
+    With `timing` the pipeline stages can be wrapped by `timed()` and
+    `timed_iter()` to add up the seconds spent in each named section, and
+    `timed_rule()` counts the calls, matches and seconds of a regexp. The
+    sections are exclusive, time spent in a timed section called from
+    another one is only counted once. Without `timing` nothing is wrapped,
+    so the stages run at full speed. With `json_file` every report is also
+    written there as JSON.
+    '''
+
+    def __init__(self, interval=10, output=sys.stderr, timing=False, json_file=None):
+        self.interval = interval
+        self.output = output
+        self.timing = timing
+        self.json_file = json_file
+        self.lines = 0
+        self.bytes = 0
+        self.sections = {}
+        self.rules = {}
+        self._timed_total = 0.0
+        self.start_time = time.monotonic()
+        self._next_report = self.start_time + interval
+
+    def wrap(self, lines, section="read"):
+        if self.timing:
+            lines = self.timed_iter(lines, section)
+        for line in lines:
+            self.lines += 1
+            # decoded lines are counted by their encoded size so that MB/s stays a byte rate
+            self.bytes += len(line) if isinstance(line, bytes) else len(line.encode("utf-8"))
+            if not self.lines & 0xffff:
+                self.tick()
+            yield line
+
+    def count(self, lines, nbytes):
+        self.lines += lines
+        self.bytes += nbytes
+        self.tick()
+
+    def tick(self):
+        if self.interval and time.monotonic() >= self._next_report:
+            self.report()
+
+    def _add_section(self, name, spent, nested):
+        own = spent - (self._timed_total - nested)
+        self.sections[name] = self.sections.get(name, 0.0) + own
+        self._timed_total += own
+
+    def timed(self, name, function):
+        ''' `function` adding its running time to the section `name` '''
+        clock = time.perf_counter
+
+        def _timed(*args, **kwargs):
+            nested = self._timed_total
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._add_section(name, clock() - start, nested)
+        return _timed
+
+    def timed_iter(self, iterable, name):
+        ''' Items of `iterable`, the time spent producing them goes to `name` '''
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            nested = self._timed_total
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._add_section(name, clock() - start, nested)
+                return
+            self._add_section(name, clock() - start, nested)
+            yield item
+
+    def timed_rule(self, name, regexp):
+        ''' `regexp(line, pos)` counting its calls, matches and seconds '''
+        clock = time.perf_counter
+        counters = self.rules.setdefault(name, {"calls": 0, "matches": 0, "seconds": 0.0})
+
+        def _timed_rule(line, pos=0):
+            start = clock()
+            match = regexp(line, pos)
+            counters["seconds"] += clock() - start
+            counters["calls"] += 1
+            if match:
+                counters["matches"] += 1
+            return match
+        return _timed_rule
+
+    def merge(self, other):
+        ''' Adds the counters of `other.as_dict()`, e.g. from a worker process '''
+        self.lines += other["lines"]
+        self.bytes += other["bytes"]
+        for name, seconds in other.get("sections", {}).items():
+            self.sections[name] = self.sections.get(name, 0.0) + seconds
+        for name, counters in other.get("rules", {}).items():
+            mine = self.rules.setdefault(name, {"calls": 0, "matches": 0, "seconds": 0.0})
+            for key, value in counters.items():
+                mine[key] += value
+
+    def reset(self):
+        self.lines = 0
+        self.bytes = 0
+        self.sections = {}
+        for counters in self.rules.values():
+            counters.update(calls=0, matches=0, seconds=0.0)
+
+    def as_dict(self):
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        stats = {
+            "lines": self.lines,
+            "bytes": self.bytes,
+            "elapsed": round(elapsed, 3),
+            "lines_per_sec": round(self.lines / elapsed, 1),
+            "mbytes_per_sec": round(self.bytes / elapsed / 1024 / 1024, 3),
+        }
+        if self.timing:
+            stats["sections"] = {name: round(seconds, 6) for name, seconds in self.sections.items()}
+            stats["rules"] = {
+                name: dict(counters, seconds=round(counters["seconds"], 6))
+                for name, counters in sorted(self.rules.items(), key=lambda item: -item[1]["seconds"])
+            }
+        return stats
+
+    def report(self, rules=5):
+        ''' Writes the stats to stderr with the `rules` slowest rules, None for all '''
+        stats = self.as_dict()
+        self.output.write(
+            f"[stats] {stats['lines']} lines, {stats['lines_per_sec']} lines/s, "
+            f"{stats['mbytes_per_sec']} MB/s, {stats['elapsed']}s\n"
+        )
+        if self.timing:
+            sections = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in stats["sections"].items())
+            self.output.write(f"[stats] {sections}\n")
+            for name, counters in list(stats["rules"].items())[:rules]:
+                self.output.write(f"[stats] rule {name} : {counters['matches']}/{counters['calls']} matches, "
+                                  f"{counters['seconds']:.3f}s\n")
+        if self.json_file:
+            tmp_file = f"{self.json_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(stats, f)
+            os.replace(tmp_file, self.json_file)
+        self._next_report = time.monotonic() + self.interval
+
+
+compression_magic = {
+    b'\x1f\x8b': 'gz',
+    b'\x28\xb5\x2f\xfd': 'zst',
+    b'BZh': 'bz2',
+}
+
+# multi-threaded decompressors first, each runs beside the parser on its own cores
+decompress_commands = {
+    'gz': [['pigz', '-dc'], ['gzip', '-dc']],
+    'zst': [['zstd', '-dcq', '-T0'], ['zstd', '-dcq']],
+    'bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']],
+}
+
+
+def detect_compression(filename):
+    ''' 'gz', 'zst', 'bz2' by the magic bytes of the file, or None '''
+    if filename == "-":
+        return None
+    with open(filename, "rb") as f:
+        head = f.read(4)
+    for magic, compression in compression_magic.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+class DecompressPipe(io.RawIOBase):
+    ''' Raw reader of the stdout of a decompressing process, raises
+        OSError at the end of the data when the process failed.
+    '''
+
+    def __init__(self, command, filename):
+        self.command = command
+        self.process = subprocess.Popen(command + ["--", filename], stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, bufsize=0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.process.stdout.readinto(buffer)
+        if not size and self.process.wait() != 0:
+            error = self.process.stderr.read().decode("utf-8", "replace").strip()
+            raise OSError(f"{' '.join(self.command)}: {error or self.process.returncode}")
+        return size
+
+    def close(self):
+        if not self.closed:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process.stderr.close()
+        super().close()
+
+
+def open_logfile(filename):
+    ''' Opens a log file for binary reading. gzip, zstd and bzip2 files are
+        decompressed by pigz, `zstd -T0` or lbzip2/pbzip2 when installed,
+        otherwise by the gzip, bz2 or zstandard modules.
+    '''
+    compression = detect_compression(filename)
+    if compression is None:
+        return open(filename, "rb", buffering=1024 * 1024)
+    for command in decompress_commands[compression]:
+        if shutil.which(command[0]):
+            return io.BufferedReader(DecompressPipe(command, filename), 1024 * 1024)
+    if compression == 'gz':
+        return gzip.open(filename, "rb")
+    if compression == 'bz2':
+        return bz2.open(filename, "rb")
+    if zstandard is None:
+        raise OSError(f"{filename}: zstd compressed, install zstd or the zstandard module")
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True), 1024 * 1024)
+
+
+def iter_lines(source, follow=False, poll_interval=0.5):
+    ''' Lines of a log file, or of stdin for "-". With `follow` the file is
+        read on as it grows, like `tail -f`. Every line ends with "\n", also
+        the last line of a file that has none, so records of different files
+        never run together.
+    '''
+    if source == "-":
+        for line in sys.stdin.buffer:
+            line = line.decode("utf-8", "replace")
+            yield line if line.endswith("\n") else line + "\n"
+        return
+    with io.TextIOWrapper(open_logfile(source), encoding="utf-8", errors="replace", newline="\n") as f:
+        while True:
+            for line in f:
+                # while following, a line without "\n" is still being written
+                yield line if follow or line.endswith("\n") else line + "\n"
+            if not follow:
+                return
+            time.sleep(poll_interval)
+
+
+rotated_suffix = re.compile(r'\.(\d+)(\.gz|\.zst|\.bz2)?|\.gz|\.zst|\.bz2')
+
+
+def expand_logfiles(logfiles, rotated=False):
+    ''' The log files, each once. With `rotated` every file is preceded by
+        its rotated siblings (`.gz`, `.2.zst`, `.1`, ...), oldest first.
+    '''
+    result = []
+    seen = set()
+    for logfile in logfiles:
+        candidates = [logfile]
+        if rotated and logfile != "-":
+            siblings = []
+            for path in glob.glob(glob.escape(logfile) + ".*"):
+                match = rotated_suffix.fullmatch(path[len(logfile):])
+                if match:
+                    siblings.append((int(match.group(1) or 0), path))
+            candidates = [path for _, path in sorted(siblings, reverse=True)] + candidates
+        for path in candidates:
+            key = path if path == "-" else os.path.realpath(path)
+            if key not in seen:
+                seen.add(key)
+                result.append(path)
+    return result
+
+
+def source_labels(logfiles):
+    ''' Short names of the log files: the file name, or the last two path
+        components when the same file name comes from several directories.
+    '''
+    names = [os.path.basename(path) for path in logfiles]
+    return [
+        name if names.count(name) == 1 else os.path.join(os.path.basename(os.path.dirname(os.path.abspath(path))), name)
+        for name, path in zip(names, logfiles)
+    ]
+
+
+def iter_records(lines):
+    ''' Groups lines into (timestamp, lines) records of a timestamped line
+        and its continuation lines. Lines before the first timestamp get an
+        empty timestamp.
+    '''
+    timestamp = ""
+    record = []
+    for line in lines:
+        if line[19:20] == ',' and line[4:5] == '-' and line[13:14] == ':':
+            if record:
+                yield timestamp, record
+            timestamp = line[:23]
+            record = [line]
+        else:
+            record.append(line)
+    if record:
+        yield timestamp, record
+
+
+def merge_logfiles(logfiles):
+    ''' k-way merge of the records of several log files by timestamp.
+
+    Yields (label, lines) with the lines of a record kept together. Each
+    file is read as a stream, so only one record per file is held in
+    memory, and records with the same timestamp keep the order of
+    `logfiles`. A file is read on without touching the heap for as long as
+    its records are older than the head of every other file, which is
+    most of the time for rotated files and nodes with skewed clocks.
+    '''
+    labels = source_labels(logfiles)
+    heap = []
+    for index, logfile in enumerate(logfiles):
+        records = iter_records(iter_lines(logfile))
+        for timestamp, record in records:
+            # (timestamp, index) is unique, so the heap never compares the records
+            heap.append((timestamp, index, record, records))
+            break
+    heapq.heapify(heap)
+
+    while len(heap) > 1:
+        timestamp, index, record, records = heapq.heappop(heap)
+        label = labels[index]
+        yield label, record
+        limit = heap[0][:2]
+        for timestamp, record in records:
+            if (timestamp, index) > limit:
+                heapq.heappush(heap, (timestamp, index, record, records))
+                break
+            yield label, record
+
+    if heap:
+        timestamp, index, record, records = heap[0]
+        label = labels[index]
+        yield label, record
+        for timestamp, record in records:
+            yield label, record
+
+
+def iter_logfiles(logfiles, follow=False):
+    ''' Lines of one log file, or the merged timeline of several '''
+    if len(logfiles) == 1:
+        return iter_lines(logfiles[0], follow=follow)
+    return merged_lines(logfiles, tag=False)
+
+
+def merged_lines(logfiles, tag=True):
+    ''' Lines of the merged timeline, prefixed with `[label] ` when `tag` '''
+    for label, record in merge_logfiles(logfiles):
+        if tag:
+            prefix = f"[{label}] "
+            for line in record:
+                yield prefix + line
+        else:
+            yield from record
+
+
+def stream_metrics(lines, parser=None, batcher=None, stats=None):
+    ''' Single pass pipeline: lines -> MultilineParser -> MetricBatcher.
+        Yields lists of aggregated points as time buckets are closed.
+    '''
+    parser = parser or MultilineParser(loopchain_line)
+    batcher = batcher or MetricBatcher()
+    points = parser.parse(lines)
+    add = batcher.add
+    if stats and stats.timing:
+        points = stats.timed_iter(points, "parse")
+        add = stats.timed("aggregate", add)
+    for point in points:
+        batch = add(point)
+        if batch:
+            yield batch
+    batch = batcher.flush()
+    if batch:
+        yield batch
+
+
+class VoteTimeline(object):
+    ''' Reconstructs the vote tallies and timings of each consensus round.
+
+    A round is opened by a `new round N` line or by a higher `height(N)`.
+    A `Votes : Votes` line is followed by a block of `Name   : state` lines,
+    e.g. `True   : 15/22`, whose `Height` and `Round` entries take
+    precedence over the current round. `feed()` returns the records of the
+    rounds closed by a line and `flush()` the last one, so only the active
+    round and the active votes block are kept in memory.
+    '''
+    height_regex = re.compile(r'\bheight\((\d+)\)')
+    round_regex = re.compile(r'new round (\d+)')
+    vote_line = re.compile(r'^(?P<vote>[a-zA-Z]\w*)(\s+)(:(?P<state>.*))?$')
+
+    def __init__(self):
+        self.round = None
+        self.block = None
+
+    @staticmethod
+    def _elapsed_ms(start, end):
+        if not start or not end:
+            return None
+        return int((parse_date(end) - parse_date(start)).total_seconds() * 1000)
+
+    def _open(self, height, round_number, timestamp):
+        self.round = {
+            "height": height, "round": round_number, "start": timestamp, "last": timestamp,
+            "first_vote": None, "last_vote": None, "blocks": 0, "votes": {},
+        }
+
+    def _close(self, end=None):
+        current, self.round = self.round, None
+        if current is None or not (current["blocks"] or current["round"] is not None):
+            # heights passing by without a round or votes, e.g. during block sync
+            return []
+        end = end or current["last"]
+        return [{
+            "height": current["height"],
+            "round": current["round"],
+            "start": current["start"],
+            "end": end,
+            "duration_ms": self._elapsed_ms(current["start"], end),
+            "first_vote_ms": self._elapsed_ms(current["start"], current["first_vote"]),
+            "last_vote_ms": self._elapsed_ms(current["start"], current["last_vote"]),
+            "blocks": current["blocks"],
+            "votes": current["votes"],
+        }]
+
+    def _move(self, height, round_number, timestamp):
+        ''' Makes height/round the active round, returns the closed records '''
+        current = self.round
+        if current is not None:
+            if height is None:
+                height = current["height"]
+            if height == current["height"]:
+                if round_number is None or round_number == current["round"]:
+                    return []
+                if current["round"] is None and not current["blocks"]:
+                    current["round"] = round_number
+                    return []
+        records = self._close(timestamp)
+        self._open(height, round_number, timestamp)
+        return records
+
+    def _end_block(self):
+        block, self.block = self.block, None
+        votes = block["votes"]
+        position = {name.lower(): votes.pop(name) for name in list(votes) if name.lower() in ("height", "round")}
+        height = position.get("height")
+        round_number = position.get("round")
+        records = self._move(int(height) if str(height).isdigit() else None,
+                             int(round_number) if str(round_number).isdigit() else None,
+                             block["timestamp"])
+        current = self.round
+        current["blocks"] += 1
+        current["first_vote"] = current["first_vote"] or block["timestamp"]
+        current["last_vote"] = block["timestamp"]
+        current["votes"] = votes
+        return records
+
+    def _add_vote(self, match):
+        state = (match.group('state') or '').strip()
+        count, separator, total = state.partition("/")
+        if separator and count.strip().isdigit() and total.strip().isdigit():
+            state = {"count": int(count), "total": int(total)}
+        self.block["votes"][match.group('vote')] = state
+
+    def feed(self, line):
+        line = line.rstrip('\r\n')
+        records = []
+        if self.block is not None:
+            match = self.vote_line.match(line)
+            if match:
+                self._add_vote(match)
+                return records
+            records = self._end_block()
+        if 'eight(' not in line and 'new round' not in line and 'Votes : Votes' not in line:
+            if self.round is not None and line[19:20] == ',':
+                self.round["last"] = line[:23]
+            return records
+        data = parse_loopchain_line(line)
+        if not data:
+            return records
+        timestamp = data['timestamp']
+        message = data['message']
+        height_match = self.height_regex.search(message)
+        height = int(height_match.group(1)) if height_match else None
+        round_match = self.round_regex.search(message)
+        if "Votes : Votes" in message:
+            self.block = {"timestamp": timestamp, "votes": {}}
+        elif round_match:
+            records += self._move(height, int(round_match.group(1)), timestamp)
+        elif height is not None and (self.round is None or self.round["height"] is None or height > self.round["height"]):
+            records += self._move(height, None, timestamp)
+        if self.round is not None:
+            self.round["last"] = timestamp
+        return records
+
+    def flush(self):
+        records = self._end_block() if self.block is not None else []
+        return records + self._close()
+
+    def parse(self, lines):
+        ''' Yields one record per round of an iterable of lines '''
+        for line in lines:
+            yield from self.feed(line)
+        yield from self.flush()
+
+
+vote_csv_fields = ["height", "round", "start", "end", "duration_ms", "first_vote_ms", "last_vote_ms", "blocks",
+                   "vote", "count", "total", "state"]
+
+
+def format_vote_csv(record):
+    ''' CSV rows of a VoteTimeline record, one per vote name '''
+    columns = [record[name] for name in vote_csv_fields[:8]]
+    rows = []
+    for vote, state in (record["votes"].items() or [("", "")]):
+        if isinstance(state, dict):
+            vote_columns = [vote, state["count"], state["total"], ""]
+        else:
+            vote_columns = [vote, "", "", state]
+        rows.append(columns + vote_columns)
+    return rows
+
+
+class LogIndex(object):
+    ''' Sidecar columnar index of a loopchain log file, stored in the
+        `<logfile>.idx` directory.
+
+    One row per log record (a timestamped line plus its continuation
+    lines) with the byte offset of the record and the dictionary encoded
+    level, file, function and peer_id columns, each in its own binary file.
+    Timestamped lines whose head cannot be parsed get their own row with
+    empty column values.
+    meta.json holds the dictionaries and one bucket per minute with the
+    first row and byte offset of that minute, so a query only reads the
+    columns and the part of the log it needs.
+    '''
+    version = 2
+    columns = {'offset': 'Q', 'level': 'H', 'file': 'I', 'function': 'I', 'peer_id': 'I'}
+    flush_rows = 1024 * 1024
+    # looser than parse_loopchain_line: any level name padded with one or more spaces
+    # (WARNING, CRITICAL), a timestamped line that does not match gets an empty row
+    head = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} \d+ \d+ (?P<peer_id>\w+) \w+ (?P<level>\w+) +'
+                      r'\[(?P<file>[^:\]]*):(?P<function>[^\]]*):\d*\]').match
+    unknown = {'level': '', 'file': '', 'function': '', 'peer_id': ''}
+
+    def __init__(self, logfile, index_dir=None):
+        self.logfile = logfile
+        self.index_dir = index_dir or f"{logfile}.idx"
+        self.meta = None
+
+    def _source_info(self):
+        stat = os.stat(self.logfile)
+        return {"size": stat.st_size, "mtime": stat.st_mtime, "inode": stat.st_ino}
+
+    def build(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        dictionaries = {name: {} for name in self.columns if name != 'offset'}
+        rows = {name: array.array(code) for name, code in self.columns.items()}
+        outputs = {name: open(os.path.join(self.index_dir, f"{name}.bin"), "wb") for name in self.columns}
+        buckets = []
+        row_count = 0
+        offset = 0
+        source = self._source_info()
+
+        with open(self.logfile, "rb", buffering=1024 * 1024) as f:
+            for raw in f:
+                line = raw.decode("utf-8", "replace")
+                # a record starts at every timestamp prefix, like iter_records()
+                if line[19:20] == ',' and line[4:5] == '-' and line[13:14] == ':':
+                    match = self.head(line)
+                    data = match.groupdict() if match else self.unknown
+                    minute = line[:16]
+                    if not buckets or minute > buckets[-1][0]:
+                        buckets.append([minute, row_count, offset])
+                    rows['offset'].append(offset)
+                    for name, dictionary in dictionaries.items():
+                        code = dictionary.get(data[name])
+                        if code is None:
+                            code = dictionary[data[name]] = len(dictionary)
+                        rows[name].append(code)
+                    row_count += 1
+                    if not row_count % self.flush_rows:
+                        for name, column in rows.items():
+                            column.tofile(outputs[name])
+                            del column[:]
+                offset += len(raw)
+
+        for name, column in rows.items():
+            column.tofile(outputs[name])
+            outputs[name].close()
+        self.meta = {
+            "version": self.version,
+            "source": source,
+            "rows": row_count,
+            "end_offset": offset,
+            "dictionaries": {name: list(dictionary) for name, dictionary in dictionaries.items()},
+            "buckets": buckets,
+        }
+        with open(os.path.join(self.index_dir, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+        return self
+
+    def load(self):
+        ''' Loads meta.json, returns False when the index is missing or stale '''
+        try:
+            with open(os.path.join(self.index_dir, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if meta.get("version") != self.version or meta.get("source") != self._source_info():
+            return False
+        self.meta = meta
+        return True
+
+    def _column(self, name):
+        with open(os.path.join(self.index_dir, f"{name}.bin"), "rb") as f:
+            if not self.meta["rows"]:
+                return memoryview(array.array(self.columns[name]))
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(data).cast(self.columns[name])
+
+    def _row_range(self, since=None, until=None):
+        minutes = [bucket[0] for bucket in self.meta["buckets"]]
+        start = 0
+        end = self.meta["rows"]
+        if since:
+            position = max(bisect.bisect_right(minutes, since[:16]) - 1, 0)
+            start = self.meta["buckets"][position][1] if minutes else 0
+        if until:
+            position = bisect.bisect_right(minutes, until[:16])
+            if position < len(minutes):
+                end = self.meta["buckets"][position][1]
+        return start, end
+
+    def query(self, since=None, until=None, **filters):
+        ''' Yields the records (text, continuation lines included) between
+            `since` and `until` ("YYYY-MM-DD HH:MM[:SS[,mmm]]", until is
+            exclusive) whose columns match `filters`, e.g. level=["ERROR"].
+        '''
+        start, end = self._row_range(since, until)
+        offsets = self._column('offset')
+        selected = range(start, end)
+        for name, values in filters.items():
+            if not values:
+                continue
+            dictionary = self.meta["dictionaries"][name]
+            codes = {dictionary.index(value) for value in values if value in dictionary}
+            column = self._column(name)
+            selected = [row for row in selected if column[row] in codes]
+
+        with open(self.logfile, "rb") as f:
+            for row in selected:
+                record_end = offsets[row + 1] if row + 1 < self.meta["rows"] else self.meta["end_offset"]
+                f.seek(offsets[row])
+                record = f.read(record_end - offsets[row]).decode("utf-8", "replace")
+                timestamp = record[:23]
+                if (since and timestamp < since) or (until and timestamp >= until):
+                    continue
+                yield record
+
+
+def format_point(point):
+    name, timestamp, value, attributes = point
+    return json.dumps({"metric": name, "timestamp": timestamp.isoformat(), "value": value, **attributes})
 
 
 def get_parser():
     parser = argparse.ArgumentParser(description='Change peer_id to hostname in the loopchain log file')
     # positional argument for command
-    parser.add_argument('command', nargs='?', help='cat, tail', default="cat")
-    parser.add_argument('--logfile', metavar='logfile', help=f'log file', default="/app/prep/data/loopchain/log/loopchain.channel.icon_dex.log")
+    parser.add_argument('command', nargs='?', help='cat, stream, index, query, votes, merge', default="cat")
+    parser.add_argument('--logfile', metavar='logfile', nargs='+', help=f'log files, - for stdin, several files are merged by timestamp', default=["/app/prep/data/loopchain/log/loopchain.channel.icon_dex.log"])
+    parser.add_argument('-r', '--rotated', action='store_true', help=f'include the rotated .1, .2, .gz siblings of each log file')
+    parser.add_argument('-f', '--follow', action='store_true', help=f'keep reading the log file as it grows (stream)')
+    parser.add_argument('--bucket', metavar='bucket', type=int, help=f'seconds per metric time bucket (stream)', default=60)
+    parser.add_argument('--since', metavar='since', help=f'start time "YYYY-MM-DD HH:MM[:SS]" (query)', default=None)
+    parser.add_argument('--until', metavar='until', help=f'end time "YYYY-MM-DD HH:MM[:SS]", exclusive (query)', default=None)
+    parser.add_argument('--level', metavar='level', nargs='+', help=f'log levels to show (query)', default=None)
+    parser.add_argument('--file', metavar='file', nargs='+', help=f'source files to show (query)', default=None)
+    parser.add_argument('--function', metavar='function', nargs='+', help=f'functions to show (query)', default=None)
+    parser.add_argument('--peer-id', metavar='peer-id', nargs='+', help=f'peer ids to show (query)', default=None)
+    parser.add_argument('--format', metavar='format', choices=['json', 'csv'], help=f'output format of the vote rounds (votes)', default="json")
+    parser.add_argument('--stats', action='store_true', help=f'time the read, parse, aggregate and output sections (cat, stream, votes)')
+    parser.add_argument('--stats-json', metavar='stats-json', help=f'also write every stats report to this JSON file', default=None)
+    parser.add_argument('--stats-interval', metavar='stats-interval', type=int, help=f'seconds between throughput reports on stderr, 0 = only at the end', default=10)
     return parser
 
 
@@ -205,17 +1002,22 @@ if __name__ == '__main__':
     args = parser.parse_args()
     result = {}
     total_count = 0
+    logfiles = expand_logfiles(args.logfile, args.rotated)
+    if len(logfiles) > 1 and (args.follow or args.command in ("index", "query")):
+        parser.error("--follow, index and query take a single log file")
+    if (args.follow or args.command in ("index", "query")) and detect_compression(logfiles[0]):
+        parser.error("--follow, index and query need an uncompressed log file")
+
+    stats = ThroughputStats(args.stats_interval, timing=args.stats, json_file=args.stats_json)
+    write = stats.timed("output", sys.stdout.write) if args.stats else sys.stdout.write
+
     if args.command == "cat":
-        f = subprocess.Popen(['cat', args.logfile],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        first_line = re.compile(r'^(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) (?P<pid>\d+) (?P<thread_id>\d+) (?P<peer_id>\w{8}) '                                
-                                r'(?P<channel>\w+) (?P<level>[^ ]\w+) (\s+) \[(?P<file>.*):(?P<function>.*):(?P<line>.*)\] (?P<message>.*)$')
-        for line in f.stdout:
-            line = line.decode("utf-8").rstrip('\r\n')
-            match = first_line.match(line)
-            if match:
-                data = match.groupdict()
+        parse_line = stats.timed("parse", parse_loopchain_line) if args.stats else parse_loopchain_line
+        lines = stats.wrap(iter_logfiles(logfiles)) if args.stats or args.stats_json else iter_logfiles(logfiles)
+        for line in lines:
+            line = line.rstrip('\r\n')
+            data = parse_line(line)
+            if data:
                 if "Votes : Votes" in data.get('message'):
                     find_vote = data
                     print(f"\n{find_vote['timestamp']}", end=" ")
@@ -228,7 +1030,51 @@ if __name__ == '__main__':
                     result[count_key] += 1
                     total_count += 1
 
-    dump(result)
-    dump(dict(sorted(result.items(), key=lambda item: item[1])))
+        dump(result)
+        dump(dict(sorted(result.items(), key=lambda item: item[1])))
+
+        dump(f"total_line = {total_count}")
+        if args.stats or args.stats_json:
+            stats.report()
+
+    elif args.command == "stream":
+        lines = stats.wrap(iter_logfiles(logfiles, follow=args.follow)) if args.stats or args.stats_json else iter_logfiles(logfiles, follow=args.follow)
+        for batch in stream_metrics(lines, batcher=MetricBatcher(args.bucket), stats=stats):
+            write("".join(format_point(point) + "\n" for point in batch))
+            sys.stdout.flush()
+        if args.stats or args.stats_json:
+            stats.report()
+
+    elif args.command == "votes":
+        lines = stats.wrap(iter_logfiles(logfiles, follow=args.follow)) if args.stats or args.stats_json else iter_logfiles(logfiles, follow=args.follow)
+        records = VoteTimeline().parse(lines)
+        if args.stats:
+            records = stats.timed_iter(records, "parse")
+        if args.format == "csv":
+            writer = csv.writer(sys.stdout)
+            writer.writerow(vote_csv_fields)
+            writerows = stats.timed("output", writer.writerows) if args.stats else writer.writerows
+        for record in records:
+            if args.format == "csv":
+                writerows(format_vote_csv(record))
+            else:
+                write(json.dumps(record, separators=(",", ":")) + "\n")
+            if args.follow:
+                sys.stdout.flush()
+        if args.stats or args.stats_json:
+            stats.report()
+
+    elif args.command == "merge":
+        sys.stdout.writelines(merged_lines(logfiles, tag=len(logfiles) > 1))
 
-    dump(f"total_line = {total_count}")
+    elif args.command in ("index", "query"):
+        log_index = LogIndex(logfiles[0])
+        if args.command == "index" or not log_index.load():
+            start_time = time.monotonic()
+            log_index.build()
+            sys.stderr.write(f"[index] {log_index.meta['rows']} rows, {len(log_index.meta['buckets'])} minutes, "
+                             f"{time.monotonic() - start_time:.3f}s -> {log_index.index_dir}\n")
+        if args.command == "query":
+            for record in log_index.query(args.since, args.until, level=args.level, file=args.file,
+                                          function=args.function, peer_id=args.peer_id):
+                sys.stdout.write(record)
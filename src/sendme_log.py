@@ -8,6 +8,17 @@ from botocore.handlers import disable_signing
 import os, time, datetime
 import sys
 import zipfile
+import tarfile
+import zlib
+import struct
+import collections
+import subprocess
+import shutil
+import queue
+import re
+import hashlib
+import json
+import math
 import argparse
 from termcolor import colored, cprint
 from boto3.s3.transfer import TransferConfig
@@ -15,6 +26,10 @@ from halo import Halo
 import requests
 from multiprocessing.pool import ThreadPool
 from timeit import default_timer
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 version = "0.2"
 region_info = {
@@ -46,7 +61,8 @@ def kvPrint(key, value, color="yellow"):
     print(bcolors.WARNING + "{:>{key_value}} ".format(str(value), key_value=key_value) + bcolors.ENDC)
 
 
-def find_fastest_region():
+def rank_regions():
+    ''' Probes every region in parallel and returns the results, fastest first '''
     results = {}
     pool = ThreadPool(6)
     i = 0
@@ -64,20 +80,20 @@ def find_fastest_region():
     pool.close()
     pool.join()
 
-    last_latency = {}
+    latencies = []
     for i, p in results.items():
         data = p['data'].get()
         print(f"data => {data}") if args.verbose else False
-        if time is not None:
-            if len(last_latency) == 0:
-                last_latency = data
-            if last_latency.get("time") and data.get("time"):
-                if last_latency.get("time", 99999) >= data.get("time"):
-                    last_latency = data
+        latencies.append(data)
         print(data) if args.verbose else False
     spinner.succeed(f'[Done] Finding fastest region')
 
-    return last_latency
+    # regions that did not answer go last
+    return sorted(latencies, key=lambda data: data.get("time") or float("inf"))
+
+
+def find_fastest_region():
+    return rank_regions()[0]
 
 
 def get_my_ipaddr():
@@ -107,8 +123,8 @@ def catchMeIfYouCan(encoded_text):
     return kkk, sss
 
 
-def multi_part_upload_with_s3(filename=None, key_path=None, bucket=None, upload_type="single"):
-    start_time = default_timer()
+def get_s3_resource(bucket=None, upload_type="multi", endpoint_url=None):
+    ''' Returns the S3 resource and bucket name for a region bucket code '''
     bucket_name_prefix = "prep-logs"
     key, sec = catchMeIfYouCan(aawwss_text)
     aaa_env, sss_env = catchMeIfYouCan(aawwss_env)
@@ -119,39 +135,152 @@ def multi_part_upload_with_s3(filename=None, key_path=None, bucket=None, upload_
     else:
         BUCKET_NAME = f"{bucket_name_prefix}{bucket}"
     cprint(f"\t bucket {bucket} -> {BUCKET_NAME}") if args.verbose else False
+    options = {}
     if bucket == "-hk":
-        s3 = boto3.resource(
-            's3',
-            region_name="ap-east-1"
-        )
-    else:
-        s3 = boto3.resource(
-            's3',
-        )
-    ##single parts
+        options["region_name"] = "ap-east-1"
+    if endpoint_url:
+        options["endpoint_url"] = endpoint_url
+    s3 = boto3.resource('s3', **options)
+    # multiparts mode -> AWS S3 CLI: Anonymous users cannot initiate multipart uploads
     if upload_type == "single":
         s3.meta.client.meta.events.register('choose-signer.s3.*', disable_signing)
+    return s3, BUCKET_NAME
+
+
+class BandwidthLimiter(object):
+    ''' Shared rate limit in bytes/s, each caller sleeps until its bytes fit the rate '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = default_timer()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            now = default_timer()
+            start = max(now, self._next)
+            self._next = start + amount / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TransferPlanner(object):
+    ''' Plans a multipart upload: part size from the transfer size and
+    concurrency from the measured throughput.
+
+    The part size is the smallest whole MiB that keeps the upload within
+    S3's 10,000 part limit, and not below `min_part_size`. Part uploads go
+    through acquire()/release(), which allow `concurrency` of them at once.
+    Starting at `min_concurrency`, the limit doubles after each measurement
+    window while throughput improves by more than 10%, then settles on the
+    best level measured.
+    '''
+    max_parts = 10000
+    min_part_size = 8 * 1024 * 1024
+    max_part_size = 5 * 1024 * 1024 * 1024
+
+    def __init__(self, size=None, min_concurrency=2, max_concurrency=16, bandwidth_limit=None):
+        self.part_size = self.plan_part_size(size)
+        self.max_concurrency = max(max_concurrency, 1)
+        self.concurrency = min(min_concurrency, self.max_concurrency)
+        self.limiter = BandwidthLimiter(bandwidth_limit) if bandwidth_limit else None
+        self.ramping = self.concurrency < self.max_concurrency
+        self.history = []
+        self.bytes = 0
+        self.start_time = None
+        self._best = (0, self.concurrency)
+        self._active = 0
+        self._window_start = None
+        self._window_bytes = 0
+        self._window_parts = 0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def plan_part_size(cls, size):
+        if not size:
+            return cls.min_part_size
+        part_size = max(cls.min_part_size, math.ceil(size / cls.max_parts))
+        return min(math.ceil(part_size / (1024 * 1024)) * 1024 * 1024, cls.max_part_size)
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.concurrency:
+                self._cond.wait()
+            self._active += 1
+            if self.start_time is None:
+                self.start_time = self._window_start = default_timer()
+
+    def release(self, amount=None):
+        with self._cond:
+            self._active -= 1
+            if amount is not None:
+                self.bytes += amount
+                self._window_bytes += amount
+                self._window_parts += 1
+                if self.ramping and self._window_parts >= self.concurrency * 2:
+                    self._adjust()
+            self._cond.notify_all()
+
+    def _adjust(self):
+        now = default_timer()
+        rate = self._window_bytes / max(now - self._window_start, 1e-6)
+        self.history.append((self.concurrency, rate))
+        if rate > self._best[0] * 1.1:
+            self._best = (rate, self.concurrency)
+            if self.concurrency < self.max_concurrency:
+                self.concurrency = min(self.concurrency * 2, self.max_concurrency)
+            else:
+                self.ramping = False
+        else:
+            self.concurrency = self._best[1]
+            self.ramping = False
+        if args.verbose:
+            cprint(f"\t concurrency {self.history[-1][0]} -> {rate / 1024 / 1024:.2f} MB/s, next {self.concurrency}")
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_parts = 0
+
+    def throttle(self, amount):
+        if self.limiter is not None:
+            self.limiter.consume(amount)
+
+    def throughput(self):
+        if self.start_time is None:
+            return 0
+        return self.bytes / max(default_timer() - self.start_time, 1e-6)
+
+    def summary(self):
+        return f"{sizeof_fmt(self.bytes)} at {self.throughput() / 1024 / 1024:.2f} MB/s, " \
+               f"part size {sizeof_fmt(self.part_size)}, concurrency {self.concurrency}"
+
+
+def multi_part_upload_with_s3(filename=None, key_path=None, bucket=None, upload_type="single", endpoint_url=None, planner=None):
+    start_time = default_timer()
+    if filename is None:
+        cprint(f"[ERROR] filename is None", "red")
+        raise SystemExit()
+    if key_path is None:
+        key_path = filename
+    # multiparts mode -> planned part size and concurrency
+    if upload_type == "multi":
+        return resumable_upload_with_s3(filename, key_path, bucket, endpoint_url, resume=False, planner=planner)
+    s3, BUCKET_NAME = get_s3_resource(bucket, upload_type, endpoint_url)
+    ##single parts
+    if upload_type == "single":
         # config = TransferConfig(use_threads=True, multipart_threshold=1024*1024*8, multipart_chunksize=1024*1024*8)
         config = TransferConfig(multipart_threshold=838860800, max_concurrency=10, multipart_chunksize=8388608,
                                 num_download_attempts=5, max_io_queue=100, io_chunksize=262144, use_threads=True)
-    # multiparts mode -> AWS S3 CLI: Anonymous users cannot initiate multipart uploads
-    elif upload_type == "multi":
-        pass
-        config = TransferConfig(multipart_threshold=1024 * 25, max_concurrency=10,
-                                multipart_chunksize=1024 * 25, use_threads=True)
     else:
         cprint(f"Unknown upload_type-> {upload_type}", "red")
-    if filename is None:
-        cprint(f"[ERROR] filename is None", "red")
         raise SystemExit()
-    if key_path is None:
-        key_path = filename
     try:
-        s3.meta.client.upload_file(filename, BUCKET_NAME, key_path,
-                                   # ExtraArgs={'ACL': 'public-read', 'ContentType': 'text/pdf'},
-                                   Config=config,
-                                   Callback=ProgressPercentage(filename)
-                                   )
+        with TransferProgress(filename, os.path.getsize(filename)) as progress:
+            s3.meta.client.upload_file(filename, BUCKET_NAME, key_path,
+                                       # ExtraArgs={'ACL': 'public-read', 'ContentType': 'text/pdf'},
+                                       Config=config,
+                                       Callback=progress
+                                       )
     except Exception as e:
         e = str(e).replace(":", ":\n")
         cprint(f"\n[ERROR] File upload fail / cause->{e}\n", "red")
@@ -163,26 +292,533 @@ def multi_part_upload_with_s3(filename=None, key_path=None, bucket=None, upload_
     cprint(f"\n\t time_completed_at = {time_completed_at}")
 
 
-class ProgressPercentage(object):
+class MultipartUploadStream(object):
+    ''' Write-only file object uploading what is written as an S3 multipart upload.
+
+    Written bytes are cut into parts of the planner's part size and handed to
+    uploader threads through a bounded queue, so a slow link blocks the
+    writer instead of buffering the archive in memory. A thread only takes
+    a part once the TransferPlanner grants it a slot, which keeps at most
+    (concurrency + queue_size + 1) parts in memory.
+    '''
+
+    def __init__(self, client, bucket, key, planner=None, progress=None, queue_size=2):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.planner = planner or TransferPlanner()
+        self.progress = progress
+        self.part_size = self.planner.part_size
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        self.parts = {}
+        self.size = 0
+        self.part_number = 0
+        self._buffer = []
+        self._buffered = 0
+        self._error = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = [threading.Thread(target=self._upload_worker, daemon=True) for _ in range(self.planner.max_concurrency)]
+        for thread in self._threads:
+            thread.start()
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def write(self, data):
+        self._check()
+        written = len(data)
+        self._buffer.append(bytes(data))
+        self._buffered += written
+        self.size += written
+        if self._buffered >= self.part_size:
+            data = b"".join(self._buffer)
+            end = len(data) - len(data) % self.part_size
+            for start in range(0, end, self.part_size):
+                self._put_part(data[start:start + self.part_size])
+            rest = data[end:]
+            self._buffer = [rest] if rest else []
+            self._buffered = len(rest)
+        return written
+
+    def flush(self):
+        pass
+
+    def _put_part(self, body):
+        self.part_number += 1
+        self._queue.put((self.part_number, body))
+
+    def _upload_part(self, number, body):
+        self.planner.throttle(len(body))
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=body)
+        self.parts[number] = response["ETag"]
+        if self.progress is not None:
+            self.progress(len(body))
+
+    def _upload_worker(self):
+        while True:
+            self.planner.acquire()
+            item = self._queue.get()
+            if item is None:
+                self.planner.release()
+                break
+            if self._error is not None:
+                self.planner.release()
+                continue
+            try:
+                self._upload_part(*item)
+                self.planner.release(len(item[1]))
+            except Exception as e:
+                self._error = e
+                self.planner.release()
+
+    def _stop_workers(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def close(self):
+        if self._buffered or self.part_number == 0:
+            self._put_part(b"".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self._stop_workers()
+        self._check()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": number, "ETag": self.parts[number]} for number in sorted(self.parts)]})
+
+    def abort(self):
+        if self._error is None:
+            self._error = IOError("upload aborted")
+        self._stop_workers()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            cprint(f"[WARN] Cannot abort multipart upload {self.upload_id} -> {e}", "yellow")
+
+
+def stream_upload_archive(filelist, key_path, bucket=None, archive_format="zip", level=None, workers=None, endpoint_url=None, planner=None):
+    ''' Compresses the files straight into a multipart upload, without a local archive '''
+    start_time = default_timer()
+    s3, BUCKET_NAME = get_s3_resource(bucket, "multi", endpoint_url)
+    if planner is None:
+        # the archive is at most about the size of its input, which bounds the part count
+        planner = TransferPlanner(archive_input_size(filelist))
+    progress = TransferProgress(key_path)
+    try:
+        stream = MultipartUploadStream(s3.meta.client, BUCKET_NAME, key_path, planner, progress)
+    except Exception as e:
+        cprint(f"\n[ERROR] Cannot start multipart upload / cause->{e}\n", "red")
+        raise SystemExit()
+    try:
+        with progress:
+            write_archive(stream, filelist, archive_format, level, workers)
+            stream.close()
+    except KeyboardInterrupt:
+        stream.abort()
+        raise
+    except Exception as e:
+        stream.abort()
+        e = str(e).replace(":", ":\n")
+        cprint(f"\n[ERROR] File upload fail / cause->{e}\n", "red")
+        raise SystemExit()
+
+    elapsed = default_timer() - start_time
+    cprint(f"\n\t streamed {stream.part_number} parts, {planner.summary()}, time_completed_at = {elapsed:5.3f}s")
+
+
+class UploadJournal(object):
+    ''' Checkpoint journal `<file>.upload.json` of a multipart upload.
+
+    Holds the upload id, part size and the ETag of every finished part, and
+    is rewritten atomically after each part so an interrupted upload can be
+    continued with --resume.
+    '''
+
     def __init__(self, filename):
-        self._filename = filename
-        self._size = float(os.path.getsize(filename))
-        self._seen_so_far = 0
+        self.path = f"{filename}.upload.json"
+        self.state = {}
         self._lock = threading.Lock()
-        self._prevent_bytes = 0
 
-    def __call__(self, bytes_amount):
-        # To simplify we'll assume this is hooked up
-        # to a single filename.
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        return self.state
+
+    def start(self, **state):
+        self.state = dict(state, parts={})
+        self.save()
+
+    def add_part(self, number, etag):
         with self._lock:
-            self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            # tx = bytes_amount - self._prevent_bytes
-            sys.stdout.write(
-                "\r \t %s  %s / %s  (%.2f%%) " % (
-                    self._filename, self._seen_so_far, self._size,
-                    percentage))
-            sys.stdout.flush
+            self.state["parts"][str(number)] = etag
+            self.save()
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def list_uploaded_parts(client, bucket_name, key_path, upload_id):
+    parts = {}
+    paginator = client.get_paginator("list_parts")
+    for page in paginator.paginate(Bucket=bucket_name, Key=key_path, UploadId=upload_id):
+        for part in page.get("Parts", []):
+            parts[part["PartNumber"]] = (part["ETag"], part["Size"])
+    return parts
+
+
+def resumable_upload_with_s3(filename=None, key_path=None, bucket=None, endpoint_url=None, resume=False, planner=None):
+    ''' Multipart upload of `filename` that records every finished part in an
+        UploadJournal. With `resume`, when a journal of the same file and the
+        same bucket and key exists, the parts S3 already holds are listed and
+        only the missing ones are sent.
+    '''
+    start_time = default_timer()
+    stat = os.stat(filename)
+    if planner is None:
+        planner = TransferPlanner(stat.st_size)
+    part_size = planner.part_size
+    journal = UploadJournal(filename)
+    state = journal.load() if resume else {}
+    resumed = state.get("size") == stat.st_size and state.get("mtime") == stat.st_mtime
+    if resumed and (state.get("bucket") != bucket or state.get("key") != key_path):
+        cprint(f"[WARN] Journal {journal.path} is for {state.get('bucket')}:{state.get('key')}, "
+               f"not {bucket}:{key_path}, starting over", "yellow")
+        resumed = False
+    if resumed:
+        part_size = state["part_size"]
+    s3, BUCKET_NAME = get_s3_resource(bucket, "multi", endpoint_url)
+    client = s3.meta.client
+    part_count = max(1, math.ceil(stat.st_size / part_size))
+
+    def part_length(number):
+        return min(part_size, stat.st_size - (number - 1) * part_size)
+
+    uploaded = {}
+    if resumed:
+        try:
+            for number, (etag, size) in list_uploaded_parts(client, BUCKET_NAME, key_path, state["upload_id"]).items():
+                if number <= part_count and size == part_length(number):
+                    uploaded[number] = etag
+            journal.state["parts"] = {str(number): etag for number, etag in uploaded.items()}
+            journal.save()
+            cprint(f"[RESUME] {BUCKET_NAME}/{key_path} -> {len(uploaded)}/{part_count} parts already uploaded", "green")
+        except Exception as e:
+            cprint(f"[WARN] Cannot resume upload {state['upload_id']}, starting over -> {e}", "yellow")
+            uploaded = {}
+            resumed = False
+    if not resumed:
+        try:
+            upload_id = client.create_multipart_upload(Bucket=BUCKET_NAME, Key=key_path)["UploadId"]
+        except Exception as e:
+            cprint(f"\n[ERROR] Cannot start multipart upload / cause->{e}\n", "red")
+            raise SystemExit()
+        journal.start(bucket=bucket, key=key_path, upload_id=upload_id, part_size=part_size,
+                      size=stat.st_size, mtime=stat.st_mtime)
+    upload_id = journal.state["upload_id"]
+
+    progress = TransferProgress(filename, stat.st_size, sum(part_length(number) for number in uploaded))
+
+    stopped = threading.Event()
+
+    def upload_part(number):
+        if stopped.is_set():
+            return
+        planner.acquire()
+        try:
+            with open(filename, "rb") as f:
+                f.seek((number - 1) * part_size)
+                body = f.read(part_length(number))
+            planner.throttle(len(body))
+            response = client.upload_part(Bucket=BUCKET_NAME, Key=key_path, UploadId=upload_id, PartNumber=number, Body=body)
+        except Exception:
+            planner.release()
+            raise
+        planner.release(len(body))
+        journal.add_part(number, response["ETag"])
+        progress(len(body))
+
+    missing = [number for number in range(1, part_count + 1) if number not in uploaded]
+    pool = ThreadPool(planner.max_concurrency)
+    progress.start()
+    try:
+        try:
+            for _ in pool.imap_unordered(upload_part, missing):
+                pass
+        finally:
+            # let the parts in flight land in the journal before reporting
+            stopped.set()
+            pool.close()
+            pool.join()
+            progress.stop()
+        client.complete_multipart_upload(
+            Bucket=BUCKET_NAME, Key=key_path, UploadId=upload_id,
+            MultipartUpload={"Parts": [{"PartNumber": int(number), "ETag": etag}
+                                       for number, etag in sorted(journal.state["parts"].items(), key=lambda x: int(x[0]))]})
+    except Exception as e:
+        e = str(e).replace(":", ":\n")
+        cprint(f"\n[ERROR] File upload fail / cause->{e}\n", "red")
+        cprint(f"[INFO] {len(journal.state['parts'])}/{part_count} parts kept in {journal.path}, "
+               f"run again with '-uf {filename} --resume' to continue", "yellow")
+        raise SystemExit()
+    journal.remove()
+
+    elapsed = default_timer() - start_time
+    time_completed_at = "{:5.3f}s".format(elapsed)
+
+    cprint(f"\n\t {planner.summary()}, time_completed_at = {time_completed_at}")
+
+
+class RegionRacer(object):
+    ''' One contestant of race_upload_with_s3(): uploads parts of the file,
+    in order, to its own multipart upload until the deadline.
+    '''
+
+    def __init__(self, name, bucket, endpoint_url, bandwidth_limit, filename, key_path, part_size, concurrency=2):
+        self.name = name
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.bandwidth_limit = bandwidth_limit
+        self.filename = filename
+        self.key_path = key_path
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.size = os.path.getsize(filename)
+        self.part_count = max(1, math.ceil(self.size / part_size))
+        self.limiter = BandwidthLimiter(bandwidth_limit) if bandwidth_limit else None
+        self.client = None
+        self.bucket_name = None
+        self.upload_id = None
+        self.parts = {}
+        self.bytes = 0
+        self.start_time = None
+        self.error = None
+        self._next_part = 1
+        self._lock = threading.Lock()
+        self._threads = []
+        self._runner = None
+
+    def start(self, deadline):
+        self._runner = threading.Thread(target=self._run, args=(deadline,), daemon=True)
+        self._runner.start()
+
+    def join(self):
+        self._runner.join()
+        for thread in self._threads:
+            thread.join()
+
+    def throughput(self, now):
+        return self.bytes / (now - self.start_time) if self.start_time and now > self.start_time else 0
+
+    def _run(self, deadline):
+        try:
+            s3, self.bucket_name = get_s3_resource(self.bucket, "multi", self.endpoint_url)
+            self.client = s3.meta.client
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key_path)["UploadId"]
+        except Exception as e:
+            self.error = e
+            return
+        self.start_time = default_timer()
+        self._threads = [threading.Thread(target=self._upload_parts, args=(deadline,), daemon=True) for _ in range(self.concurrency)]
+        for thread in self._threads:
+            thread.start()
+
+    def _upload_parts(self, deadline):
+        with open(self.filename, "rb") as f:
+            while self.error is None and default_timer() < deadline:
+                with self._lock:
+                    number = self._next_part
+                    if number > self.part_count:
+                        return
+                    self._next_part += 1
+                f.seek((number - 1) * self.part_size)
+                body = f.read(self.part_size)
+                try:
+                    if self.limiter is not None:
+                        self.limiter.consume(len(body))
+                    response = self.client.upload_part(Bucket=self.bucket_name, Key=self.key_path, UploadId=self.upload_id,
+                                                       PartNumber=number, Body=body)
+                except Exception as e:
+                    self.error = e
+                    return
+                with self._lock:
+                    self.parts[number] = response["ETag"]
+                    self.bytes += len(body)
+
+    def abort(self):
+        ''' Aborts the upload without waiting for the parts in flight '''
+        if self.upload_id is None:
+            return
+        self.error = self.error or IOError("aborted")
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key_path, UploadId=self.upload_id)
+        except Exception as e:
+            cprint(f"[WARN] Cannot abort the upload to {self.name} -> {e}", "yellow")
+
+
+def race_candidates(count, endpoints=None):
+    ''' (name, bucket code, endpoint url, injected bandwidth) of the regions to race.
+        `endpoints` are "URL" or "URL=MB/s" of S3 compatible stand-ins.
+    '''
+    if endpoints:
+        candidates = []
+        for endpoint in endpoints:
+            url, _, limit = endpoint.partition("=")
+            candidates.append((url, None, url, float(limit) * 1024 * 1024 if limit else None))
+        return candidates
+    return [(region["name"], region_info.get(region["name"]).split(".")[0], None, None) for region in rank_regions()[:count]]
+
+
+def race_upload_with_s3(filename, key_path, candidates, race_seconds=5, max_concurrency=16, bandwidth_limit=None):
+    ''' Uploads the first parts of `filename` to every candidate at once for
+        `race_seconds`, keeps the one with the best sustained throughput and
+        aborts the others. The parts of the winner are written to the upload
+        journal, from which resumable_upload_with_s3() continues.
+        Returns the bucket code and endpoint url of the winner.
+    '''
+    stat = os.stat(filename)
+    part_size = TransferPlanner.plan_part_size(stat.st_size)
+    racers = [RegionRacer(name, bucket, endpoint_url, limit or bandwidth_limit, filename, key_path, part_size)
+              for name, bucket, endpoint_url, limit in candidates]
+    spinner = Halo(text=f"Racing {len(racers)} regions for {race_seconds}s", spinner='dots')
+    spinner.start()
+    deadline = default_timer() + race_seconds
+    for racer in racers:
+        racer.start(deadline)
+    # the race is judged at the deadline, a contestant that has not finished a part by then is
+    # only waited for while nobody has, for at most another race_seconds
+    time.sleep(race_seconds)
+    while not any(racer.bytes for racer in racers) and default_timer() < deadline + race_seconds:
+        if all(racer.error is not None for racer in racers):
+            break
+        time.sleep(0.1)
+    now = default_timer()
+    finished = [racer for racer in racers if racer.error is None and racer.bytes]
+    if not finished:
+        spinner.fail(f'No region accepted the upload')
+        for racer in racers:
+            cprint(f"\t {racer.name} -> {racer.error or 'no part uploaded in time'}", "red")
+            racer.abort()
+        raise SystemExit()
+    winner = max(finished, key=lambda racer: racer.throughput(now))
+    spinner.succeed(f'[Done] Racing regions -> {winner.name}')
+    for racer in racers:
+        result = f"{racer.throughput(now) / 1024 / 1024:.2f} MB/s" if racer.error is None else f"failed ({racer.error})"
+        kvPrint(racer.name, f"{sizeof_fmt(racer.bytes)}, {result}")
+        if racer is not winner:
+            racer.abort()
+    winner.join()
+
+    journal = UploadJournal(filename)
+    journal.start(bucket=winner.bucket, key=key_path, upload_id=winner.upload_id, part_size=part_size,
+                  size=stat.st_size, mtime=stat.st_mtime)
+    for number, etag in winner.parts.items():
+        journal.add_part(number, etag)
+    planner = TransferPlanner(stat.st_size, max_concurrency=max_concurrency, bandwidth_limit=winner.bandwidth_limit)
+    resumable_upload_with_s3(filename, key_path, winner.bucket, winner.endpoint_url, True, planner)
+    return winner.bucket, winner.endpoint_url
+
+
+class TransferProgress(object):
+    ''' Upload progress callback with lock-free accounting.
+
+    Each calling thread adds to its own counter, so a callback is one
+    attribute lookup and an add. A reporter thread sums the counters and
+    redraws one line `refresh` times per second on a TTY, or writes a log
+    line every `log_interval` seconds otherwise. `done` counts bytes sent by
+    an earlier run; they show in the percentage but not in the throughput.
+    '''
+    refresh = 4
+    log_interval = 10
+
+    def __init__(self, label, total=None, done=0, output=sys.stdout):
+        self.label = label
+        self.total = total
+        self.done = done
+        self.output = output
+        self.is_tty = output.isatty()
+        self.interval = 1 / self.refresh if self.is_tty else self.log_interval
+        self.start_time = None
+        self._window = 3 if self.is_tty else self.log_interval * 1.5
+        self._samples = collections.deque()
+        self._counters = []
+        self._local = threading.local()
+        self._register_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, bytes_amount):
+        counter = getattr(self._local, "counter", None)
+        if counter is None:
+            counter = self._local.counter = [0]
+            with self._register_lock:
+                self._counters.append(counter)
+        counter[0] += bytes_amount
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def seen(self):
+        return sum(counter[0] for counter in list(self._counters))
+
+    def start(self):
+        self.start_time = default_timer()
+        self._samples.append((self.start_time, 0))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.render(final=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.render()
+
+    def render(self, final=False):
+        now = default_timer()
+        seen = self.seen()
+        self._samples.append((now, seen))
+        while now - self._samples[0][0] > self._window:
+            self._samples.popleft()
+        since, seen_since = self._samples[0]
+        current = (seen - seen_since) / (now - since) if now > since else 0
+        average = seen / max(now - self.start_time, 1e-6)
+        done = self.done + seen
+        text = f"{self.label}  {sizeof_fmt(done)}"
+        if self.total:
+            text += f" / {sizeof_fmt(self.total)} ({done / self.total * 100:.2f}%)"
+        text += f"  {current / 1024 / 1024:.2f} MB/s, avg {average / 1024 / 1024:.2f} MB/s"
+        if self.total and not final and average > 0:
+            eta = int(max(self.total - done, 0) / average)
+            text += f", ETA {eta // 60}:{eta % 60:02d}"
+        if self.is_tty:
+            self.output.write(f"\r \t {text:100}" + ("\n" if final else ""))
+        else:
+            self.output.write(f" \t {text}\n")
+        self.output.flush()
 
 
 def upload_s3(filename=None):
@@ -242,6 +878,262 @@ def checkFileType(filename):
         return "file"
 
 
+def _entry_info(entry, file_type):
+    stat = entry.stat()
+    return {
+        "full_filename": entry.path,
+        "size": sizeof_fmt(stat.st_size),
+        "date": datetime.datetime.fromtimestamp(stat.st_mtime),
+        "unixtime": stat.st_mtime,
+        "type": file_type
+    }
+
+
+def _is_excluded(name, exclude_dir):
+    for exclude in exclude_dir:
+        if name.count(exclude) > 0:
+            return True
+    return False
+
+
+class UploadManifest(object):
+    ''' Local record of the log bytes already shipped, for --incremental.
+
+    Every uploaded file is kept with its size, mtime, inode and the sha256
+    of each `chunk_size` chunk (the last one may be partial). On the next
+    run a file that grew on the same inode is checked by re-hashing only
+    its previous last chunk; if that still matches, only the appended range
+    is packaged. A file with a new mtime but the same size is compared
+    chunk by chunk, when it matches only its new mtime is recorded (a state
+    without "member"). Anything else (new, rotated, truncated or rewritten
+    files) is shipped in full. The manifest is saved only after the upload
+    and the bucket manifest object succeeded.
+    '''
+    chunk_size = 4 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        self.state.setdefault("files", {})
+        self.state.setdefault("uploads", [])
+
+    @staticmethod
+    def default_path(network, name):
+        return os.path.join(os.path.expanduser("~"), ".sendme_log", f"{network}-{name}.manifest.json")
+
+    def _hash_chunks(self, f, offset, end):
+        chunks = []
+        f.seek(offset)
+        while offset < end:
+            data = f.read(min(self.chunk_size, end - offset))
+            if not data:
+                break
+            chunks.append(hashlib.sha256(data).hexdigest())
+            offset += len(data)
+        return chunks, offset
+
+    def _unchanged(self, f, previous):
+        ''' Re-hashes the previous last chunk, an append-only file still matches it '''
+        if not previous["chunks"]:
+            return previous["size"] == 0
+        last_offset = (len(previous["chunks"]) - 1) * self.chunk_size
+        f.seek(last_offset)
+        return hashlib.sha256(f.read(previous["size"] - last_offset)).hexdigest() == previous["chunks"][-1]
+
+    def plan(self, filenames):
+        ''' Returns the archive entries to upload and the new file states '''
+        entries = []
+        states = {}
+        for filename in filenames:
+            path = os.path.abspath(filename)
+            previous = self.state["files"].get(path)
+            with open(filename, "rb") as f:
+                stat = os.fstat(f.fileno())
+                start = 0
+                chunks = []
+                if previous and previous["inode"] == stat.st_ino and previous["size"] <= stat.st_size:
+                    if previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime:
+                        continue
+                    if previous["size"] == stat.st_size:
+                        # touched without growing, only a full compare tells a rewrite apart
+                        if self._hash_chunks(f, 0, stat.st_size)[0] == previous["chunks"]:
+                            # nothing to ship, keep the new mtime so the next run skips the compare
+                            states[path] = dict(previous, mtime=stat.st_mtime, member=None, offset=0)
+                            continue
+                    elif self._unchanged(f, previous):
+                        start, chunks = previous["size"], previous["chunks"][:-1]
+                rehashed, end = self._hash_chunks(f, len(chunks) * self.chunk_size, stat.st_size)
+            arcname = os.path.relpath(filename)
+            if start:
+                arcname = f"{arcname}.{start}-{end}"
+            entries.append((filename, arcname, start, end - start))
+            states[path] = {"size": end, "mtime": stat.st_mtime, "inode": stat.st_ino, "chunks": chunks + rehashed,
+                            "member": arcname, "offset": start}
+        return entries, states
+
+    def remote_manifest(self, key_path, states):
+        ''' The bucket object telling the receiving side how to reassemble the files '''
+        previous = self.state["uploads"][-1]["key"] if self.state["uploads"] else None
+        return {
+            "version": 1,
+            "archive": key_path,
+            "previous": previous,
+            "created": datetime.datetime.now().isoformat(),
+            "chunk_size": self.chunk_size,
+            "files": [{"path": os.path.relpath(path), "member": state["member"], "offset": state["offset"],
+                       "length": state["size"] - state["offset"], "size": state["size"],
+                       "mode": "append" if state["offset"] else "full", "chunks": state["chunks"]}
+                      for path, state in states.items() if state["member"] is not None]
+        }
+
+    def commit(self, key_path, states):
+        ''' Stores the new file states, `key_path` None when nothing was uploaded '''
+        for path, state in states.items():
+            self.state["files"][path] = {key: state[key] for key in ("size", "mtime", "inode", "chunks")}
+        if key_path is not None:
+            self.state["uploads"].append({"key": key_path, "time": datetime.datetime.now().isoformat(),
+                                          "files": sum(state["member"] is not None for state in states.values())})
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(temp_path, self.path)
+
+
+def upload_manifest_object(document, key_path, bucket=None, endpoint_url=None):
+    s3, BUCKET_NAME = get_s3_resource(bucket, "multi", endpoint_url)
+    try:
+        s3.meta.client.put_object(Bucket=BUCKET_NAME, Key=key_path, Body=json.dumps(document, indent=1).encode(),
+                                  ContentType="application/json")
+    except Exception as e:
+        cprint(f"\n[ERROR] Manifest upload fail / cause->{e}\n", "red")
+        raise SystemExit()
+
+
+class FileSelector(object):
+    ''' Decides which log files are uploaded, from their path and mtime.
+
+    The target date spec becomes one [start, end) range of unix times:
+    "today" takes the files modified since yesterday 00:00, a date like
+    "2020-01-31" that day, "all" everything. `since` ("30m", "6h", "2d",
+    "1w") and `between` (two dates or "YYYY-MM-DD HH:MM[:SS]" times, a
+    date-only end includes its day) take precedence over the target date.
+    The exclude strings are compiled into one regular expression matched
+    against the full path.
+    '''
+    time_units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    time_formats = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d"]
+
+    def __init__(self, target_date="today", since=None, between=None, exclude_dir=[], now=None):
+        now = now or datetime.datetime.now()
+        midnight = datetime.datetime.combine(now.date(), datetime.time())
+        self.start, self.end = 0, float("inf")
+        if since:
+            match = re.match(r"^(\d+(?:\.\d+)?)([smhdw])$", since)
+            if match is None:
+                cprint(f"[ERROR] Invalid --since '{since}', use a number with s, m, h, d or w (e.g. 6h)", "red")
+                raise SystemExit()
+            self.start = now.timestamp() - float(match.group(1)) * self.time_units[match.group(2)]
+            self.label = f"since {since}"
+        elif between:
+            start, date_only = self._parse_time(between[0])
+            end, date_only = self._parse_time(between[1])
+            if date_only:
+                end += datetime.timedelta(days=1)
+            self.start, self.end = start.timestamp(), end.timestamp()
+            self.label = f"{between[0]} ~ {between[1]}"
+        elif target_date == "today":
+            self.start = (midnight - datetime.timedelta(days=1)).timestamp()
+            self.label = "today"
+        elif target_date == "all":
+            self.label = "all"
+        else:
+            day, date_only = self._parse_time(target_date)
+            self.start, self.end = day.timestamp(), (day + datetime.timedelta(days=1)).timestamp()
+            self.label = f"[{target_date}]"
+        exclude_dir = [exclude for exclude in exclude_dir if exclude]
+        self.exclude = re.compile("|".join(re.escape(exclude) for exclude in exclude_dir)) if exclude_dir else None
+
+    def _parse_time(self, text):
+        for time_format in self.time_formats:
+            try:
+                return datetime.datetime.strptime(text, time_format), time_format == "%Y-%m-%d"
+            except ValueError:
+                pass
+        cprint(f"[ERROR] Invalid date '{text}', use YYYY-MM-DD or 'YYYY-MM-DD HH:MM[:SS]'", "red")
+        raise SystemExit()
+
+    def match(self, path, mtime):
+        if not self.start <= mtime < self.end:
+            return False
+        return self.exclude is None or self.exclude.search(path) is None
+
+
+def scan_tree(dirname, exclude_dir, scan_type="file", dir_entry=None, real_path=None, selector=None):
+    ''' Walks `dirname` with os.scandir() and returns the SearchDir results.
+
+    The type of an entry comes from the directory listing and only the
+    entries that are returned are stat()ed, once, through the cached
+    DirEntry. Excluded directories are pruned before descending and the
+    walk keeps its own stack, so deep trees do not hit the recursion limit.
+    Symbolic links are followed like before, a link back to one of its
+    own parents is not descended twice.
+
+    For "file" every file is returned, or the files a FileSelector
+    `selector` matches, decided from the cached stat() of the entry; for
+    "dir" every directory without a subdirectory to descend into (the log
+    directories), in the order of the former recursive search. With `dir_entry` the entry of `dirname` itself
+    is handled like a subdirectory, which is how parallel scans of the
+    top-level subtrees are put together.
+    '''
+    result = []
+    real_path = real_path or os.path.realpath(dirname)
+    # frame: [path, real path, entries, position, DirEntry of the path, has subdirectories]
+    stack = [[dirname, real_path, None, 0, dir_entry, False]]
+    while stack:
+        frame = stack[-1]
+        if frame[2] is None:
+            with os.scandir(frame[0]) as iterator:
+                frame[2] = list(iterator)
+        path, real, entries, position = frame[:4]
+        if position == len(entries):
+            stack.pop()
+            if frame[4] is not None and scan_type == "dir" and not frame[5]:
+                try:
+                    result.append(_entry_info(frame[4], "dir"))
+                except OSError:
+                    pass
+            continue
+        frame[3] += 1
+        entry = entries[position]
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            continue
+        if is_dir:
+            if _is_excluded(entry.name, exclude_dir):
+                continue
+            frame[5] = True
+            if entry.is_symlink():
+                child_real = os.path.realpath(entry.path)
+                if real == child_real or real.startswith(child_real + os.sep):
+                    continue
+            else:
+                child_real = os.path.join(real, entry.name)
+            stack.append([entry.path, child_real, None, 0, entry, False])
+        elif scan_type == "file":
+            try:
+                if entry.is_file() and (selector is None or selector.match(entry.path, entry.stat().st_mtime)):
+                    result.append(_entry_info(entry, "file"))
+            except OSError:
+                pass
+    return result
+
+
 class SearchDir:
     if os.environ.get("IS_DOCKER") == "true":
         guess_logpath = ["/data/mainnet/log", "/data/loopchain/log"]
@@ -252,6 +1144,8 @@ class SearchDir:
     type = "dir"
     change_path = False
     exclude_dir = [".score_data", ".storage", ".git"]
+    workers = 1
+    selector = None
 
     # def __init__(self, dirname, type, return_data=[]):
     #     self.dirname = dirname
@@ -278,6 +1172,16 @@ class SearchDir:
         self.type = type
         return self
 
+    def setWorkers(self, workers):
+        ''' Scan the top-level subdirectories with this many threads '''
+        self.workers = workers
+        return self
+
+    def setSelector(self, selector):
+        ''' Only return the files this FileSelector matches '''
+        self.selector = selector
+        return self
+
     def add(self, tree):
         return self.return_data.append(tree)
 
@@ -286,41 +1190,46 @@ class SearchDir:
 
     def find(self):
         try:
-            filenames = os.listdir(self.dirname)
-        except Exception as e:
-            filenames = None
-            cprint(f"Error: '{self.dirname}' - {e}", "red")
+            if self.workers > 1:
+                self.merge(self._find_parallel())
+            else:
+                self.merge(scan_tree(self.dirname, self.exclude_dir, self.type, selector=self.selector))
+        except OSError as e:
+            cprint(f"Error: '{e.filename or self.dirname}' - {e}", "red")
             raise SystemExit()
-
-        if filenames:
-            for filename in filenames:
-                is_write = 0
-                full_filename = os.path.join(self.dirname, filename)
-                file_info = get_file_info(full_filename)
-                if file_info.get("type") is "dir":
-                    exclude_match = False
-                    for exclude in self.exclude_dir:
-                        if filename.count(exclude) > 0:  # not match
-                            exclude_match = True
-                        if exclude_match is True:
-                            break
-                    if exclude_match is False:
-                        self.merge(SearchDir(self.return_data).setType(self.type).setPath(full_filename).find())
-                if file_info.get("type") == "dir" and self.type is "dir":
-                    if full_filename in self.guess_logpath:
-                        is_write = 1
-                elif file_info.get("type") == "file" and self.type is "file":
-                    is_write = 1
-                if is_write == 1:
-                    self.add({
-                        "full_filename": full_filename,
-                        "size": file_info.get("size"),
-                        "date": file_info.get("date"),
-                        "unixtime": file_info.get("unixtime"),
-                        "type": file_info.get("type")
-                    })
         return self.return_data
 
+    def _find_parallel(self):
+        real_path = os.path.realpath(self.dirname)
+        with os.scandir(self.dirname) as iterator:
+            entries = list(iterator)
+        # the entries of the top directory are scanned here, its subtrees by the pool
+        subtrees = []
+        pool = ThreadPool(self.workers)
+        try:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                if is_dir and not _is_excluded(entry.name, self.exclude_dir):
+                    child_real = os.path.realpath(entry.path) if entry.is_symlink() else os.path.join(real_path, entry.name)
+                    if real_path == child_real or real_path.startswith(child_real + os.sep):
+                        continue
+                    subtrees.append(pool.apply_async(scan_tree, (entry.path, self.exclude_dir, self.type, entry, child_real, self.selector)))
+                elif not is_dir and self.type == "file":
+                    try:
+                        if entry.is_file() and (self.selector is None or self.selector.match(entry.path, entry.stat().st_mtime)):
+                            subtrees.append([_entry_info(entry, "file")])
+                    except OSError:
+                        pass
+            result = []
+            for subtree in subtrees:
+                result.extend(subtree if isinstance(subtree, list) else subtree.get())
+            return result
+        finally:
+            pool.close()
+
 
 def get_file_info(file):
     if os.path.isdir(file):
@@ -366,20 +1275,295 @@ def zipdir(path, ziph):
             ziph.write(os.path.join(root, file))
 
 
-def archive_zip2(filelist=[], zip_filename="archive.zip"):
-    zip = zipfile.ZipFile(f'{zip_filename}', 'w')
+def _read_range(f, length=None, block_size=1024 * 1024):
+    ''' Yields blocks from the position of `f`, `length` bytes or up to EOF '''
+    while length is None or length > 0:
+        data = f.read(block_size if length is None else min(block_size, length))
+        if not data:
+            break
+        if length is not None:
+            length -= len(data)
+        yield data
 
-    spinner = Halo(text=f"Archive files - {zip_filename}\n", spinner='dots')
-    spinner.start()
-    for filename in filelist:
+
+def _deflate_block(block, dictionary, level):
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelDeflate(object):
+    ''' pigz style deflate of a byte stream on a thread pool.
+
+    The input is cut into blocks that are compressed independently, each
+    primed with the last 32 KiB of the previous block and ended with a sync
+    flush, so the blocks joined in order form one raw deflate stream. zlib
+    releases the GIL, so the blocks compress on all cores while the CRC is
+    computed in the calling thread. At most two blocks per worker are in
+    flight.
+    '''
+    final_block = b"\x03\x00"
+
+    def __init__(self, output, level=6, pool=None, workers=None, block_size=1024 * 1024):
+        self.output = output
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count()
+        self.pool = pool or ThreadPool(self.workers)
+        self._own_pool = pool is None
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+        self._dictionary = b""
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+
+    def write(self, data):
+        written = len(data)
+        self._buffer.append(data)
+        self._buffered += written
+        if self._buffered >= self.block_size:
+            data = b"".join(self._buffer)
+            for start in range(0, len(data) - self.block_size + 1, self.block_size):
+                self._submit(data[start:start + self.block_size])
+            rest = data[len(data) - len(data) % self.block_size:]
+            self._buffer = [rest] if rest else []
+            self._buffered = len(rest)
+        return written
+
+    def _submit(self, block):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self._pending.append(self.pool.apply_async(_deflate_block, (block, self._dictionary, self.level)))
+        self._dictionary = block[-32768:]
+        while len(self._pending) > self.workers * 2:
+            self._write_block(self._pending.popleft().get())
+
+    def _write_block(self, data):
+        self.output.write(data)
+        self.compressed_size += len(data)
+
+    def finish(self):
+        if self._buffered:
+            self._submit(b"".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        while self._pending:
+            self._write_block(self._pending.popleft().get())
+        self._write_block(self.final_block)
+        if self._own_pool:
+            self.pool.close()
+
+
+class ParallelGzipWriter(object):
+    ''' Write-only gzip file object compressing with ParallelDeflate '''
+
+    def __init__(self, output, level=6, workers=None):
+        self.output = output
+        output.write(struct.pack("<4BLBB", 0x1f, 0x8b, 8, 0, int(time.time()), 0, 255))
+        self.deflate = ParallelDeflate(output, level, workers=workers)
+
+    def write(self, data):
+        return self.deflate.write(bytes(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.deflate is not None:
+            self.deflate.finish()
+            self.output.write(struct.pack("<2L", self.deflate.crc, self.deflate.size & 0xffffffff))
+            self.deflate = None
+
+
+class ZstdWriter(object):
+    ''' Write-only zstd file object, multi-threaded zstandard module or `zstd -T` '''
+
+    def __init__(self, output, level=3, workers=None):
+        workers = workers or os.cpu_count()
+        self.process = None
+        if zstandard is not None:
+            self.writer = zstandard.ZstdCompressor(level=level, threads=workers).stream_writer(output, closefd=False)
+            return
+        if not shutil.which("zstd"):
+            cprint(f"[ERROR] tar.zst needs the 'zstandard' package (pip3 install zstandard) or the zstd command", "red")
+            raise SystemExit()
+        self.output = output
+        self.process = subprocess.Popen(["zstd", f"-{level}", f"-T{workers}", "-q", "-c"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.writer = self.process.stdin
+        self._copier = threading.Thread(target=self._copy_output, daemon=True)
+        self._copier.start()
+
+    def _copy_output(self):
+        for data in iter(lambda: self.process.stdout.read(1024 * 1024), b""):
+            self.output.write(data)
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        if self.process is not None:
+            self._copier.join()
+            if self.process.wait() != 0:
+                raise OSError(f"zstd exited with {self.process.returncode}")
+
+
+class ParallelZipWriter(object):
+    ''' Streaming zip archive with members deflated by ParallelDeflate.
+
+    Sizes and CRC of a member follow its data in a data descriptor, so the
+    archive is written front to back without seeking and can go to a pipe
+    or an upload stream. Zip64 records are used for large members, offsets
+    and member counts.
+    '''
+
+    def __init__(self, output, level=6, workers=None):
+        self.output = output
+        self.level = level
+        self.workers = workers or os.cpu_count()
+        self.pool = ThreadPool(self.workers)
+        self.offset = 0
+        self.entries = []
+
+    def _write(self, data):
+        self.output.write(data)
+        self.offset += len(data)
+
+    @staticmethod
+    def _dos_time(mtime):
+        t = time.localtime(mtime)
+        if t.tm_year < 1980:
+            return 0, (1 << 5) | 1
+        return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+    def add_file(self, filename, arcname, offset=0, length=None):
+        with open(filename, "rb") as f:
+            stat = os.fstat(f.fileno())
+            f.seek(offset)
+            try:
+                name = arcname.encode("ascii")
+                flags = 0x08
+            except UnicodeEncodeError:
+                name = arcname.encode("utf-8")
+                flags = 0x08 | 0x800
+            # a log may still grow while it is read, leave room before deciding on zip64
+            zip64 = (stat.st_size - offset if length is None else length) >= 1 << 31
+            dos_time, dos_date = self._dos_time(stat.st_mtime)
+            extra = struct.pack("<2H2Q", 1, 16, 0, 0) if zip64 else b""
+            header_offset = self.offset
+            self._write(struct.pack("<L5H3L2H", 0x04034b50, 45 if zip64 else 20, flags, zipfile.ZIP_DEFLATED,
+                                    dos_time, dos_date, 0, 0xffffffff if zip64 else 0, 0xffffffff if zip64 else 0,
+                                    len(name), len(extra)) + name + extra)
+            deflate = ParallelDeflate(self.output, self.level, pool=self.pool, workers=self.workers)
+            for data in _read_range(f, length, deflate.block_size):
+                deflate.write(data)
+            deflate.finish()
+            self.offset += deflate.compressed_size
+            if zip64:
+                self._write(struct.pack("<2L2Q", 0x08074b50, deflate.crc, deflate.compressed_size, deflate.size))
+            else:
+                self._write(struct.pack("<4L", 0x08074b50, deflate.crc, deflate.compressed_size, deflate.size))
+        self.entries.append((name, flags, dos_time, dos_date, deflate.crc, deflate.compressed_size, deflate.size,
+                             header_offset, stat.st_mode))
+
+    def close(self):
+        central_offset = self.offset
+        for name, flags, dos_time, dos_date, crc, compressed_size, size, header_offset, mode in self.entries:
+            zip64_fields = [value for value in (size, compressed_size, header_offset) if value >= 0xffffffff]
+            extra = struct.pack(f"<2H{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b""
+            version = 45 if zip64_fields else 20
+            self._write(struct.pack("<L6H3L5H2L", 0x02014b50, (3 << 8) | version, version, flags, zipfile.ZIP_DEFLATED,
+                                    dos_time, dos_date, crc, min(compressed_size, 0xffffffff), min(size, 0xffffffff),
+                                    len(name), len(extra), 0, 0, 0, (mode & 0xffff) << 16,
+                                    min(header_offset, 0xffffffff)) + name + extra)
+        central_size = self.offset - central_offset
+        count = len(self.entries)
+        if count >= 0xffff or central_offset >= 0xffffffff or central_size >= 0xffffffff:
+            zip64_offset = self.offset
+            self._write(struct.pack("<LQ2H2L4Q", 0x06064b50, 44, 45, 45, 0, 0, count, count, central_size, central_offset))
+            self._write(struct.pack("<2LQL", 0x07064b50, 0, zip64_offset, 1))
+        self._write(struct.pack("<L4H2LH", 0x06054b50, 0, 0, min(count, 0xffff), min(count, 0xffff),
+                                min(central_size, 0xffffffff), min(central_offset, 0xffffffff), 0))
+        self.pool.close()
+
+
+archive_extensions = {"zip": "zip", "tar.gz": "tar.gz", "tar.zst": "tar.zst"}
+
+
+def archive_member(entry):
+    ''' (filename, arcname, offset, length) of a filename or a member tuple '''
+    if isinstance(entry, str):
+        return entry, os.path.relpath(entry), 0, None
+    return entry
+
+
+def archive_input_size(entries):
+    size = 0
+    for entry in entries:
+        filename, arcname, offset, length = archive_member(entry)
+        size += os.path.getsize(filename) - offset if length is None else length
+    return size
+
+
+def write_archive(output, filelist, archive_format="zip", level=None, workers=None):
+    ''' Writes the files into the binary file object `output` as zip,
+        tar.gz or tar.zst, compressing on `workers` cores. An entry is a
+        filename, or a (filename, arcname, offset, length) tuple to store a
+        byte range of the file.
+    '''
+    if archive_format == "zip":
+        archive = ParallelZipWriter(output, 6 if level is None else level, workers)
+    elif archive_format == "tar.gz":
+        compressed = ParallelGzipWriter(output, 6 if level is None else level, workers)
+        archive = tarfile.open(fileobj=compressed, mode="w|")
+    elif archive_format == "tar.zst":
+        compressed = ZstdWriter(output, 3 if level is None else level, workers)
+        archive = tarfile.open(fileobj=compressed, mode="w|")
+    else:
+        cprint(f"Unknown archive format-> {archive_format}", "red")
+        raise SystemExit()
+
+    for entry in filelist:
+        filename, arcname, offset, length = archive_member(entry)
+        print(f" -> {filename}" if arcname == os.path.relpath(filename) else f" -> {filename} ({arcname})")
         try:
-            print(f" -> {filename}")
-            zip.write(filename,
-                      os.path.relpath(filename),
-                      compress_type=zipfile.ZIP_DEFLATED)
-        except Exception as e:
+            if archive_format == "zip":
+                archive.add_file(filename, arcname, offset, length)
+            elif offset == 0 and length is None:
+                archive.add(filename, arcname, recursive=False)
+            else:
+                with open(filename, "rb") as f:
+                    info = archive.gettarinfo(arcname=arcname, fileobj=f)
+                    info.size = os.fstat(f.fileno()).st_size - offset if length is None else length
+                    f.seek(offset)
+                    archive.addfile(info, f)
+        except OSError as e:
             cprint(f"[ERR] {e}")
-            spinner.fail(f'Fail {e}')
+    archive.close()
+    if archive_format != "zip":
+        compressed.close()
+
+
+def archive_files(filelist=[], archive_filename="archive.zip", archive_format="zip", level=None, workers=None):
+    spinner = Halo(text=f"Archive files - {archive_filename}\n", spinner='dots')
+    spinner.start()
+    try:
+        with open(archive_filename, "wb") as output:
+            write_archive(output, filelist, archive_format, level, workers)
+    except Exception as e:
+        spinner.fail(f'Fail {e}')
+        raise SystemExit()
     spinner.succeed(f'Archive Done')
 
 
@@ -412,11 +1596,27 @@ def get_parser():
 
     # parser.add_argument('-td', '--target-date', type=str, choices=["all", "today"], help=f'upload target date', default=f'today')
     parser.add_argument('-td', '--target-date', type=str, help=f'upload target date', default=f'today')
+    parser.add_argument('--since', metavar='since', type=str, help=f'upload the files modified in the last period, e.g. 30m, 6h, 2d', default=None)
+    parser.add_argument('--between', metavar='date', type=str, nargs=2, help=f'upload the files modified between two dates or "YYYY-MM-DD HH:MM" times', default=None)
     parser.add_argument('-n', '--name', type=str, help=f'Set filename for upload ', default=None)
     parser.add_argument('-u', '--upload', action='count', help=f'force upload mode', default=0)
     parser.add_argument('-uf', '--upload-filename', type=str, help=f'upload upload mode', default=0)
     parser.add_argument('-ut', '--upload-type', type=str, help=f'upload type', choices=["single", "multi"], default="multi")
     parser.add_argument('-v', '--verbose', action='count', help=f'verbose mode ', default=0)
+    parser.add_argument('--archive-format', metavar='archive-format', type=str, help=f'archive format', choices=list(archive_extensions), default="zip")
+    parser.add_argument('--compress-level', metavar='compress-level', type=int, help=f'compression level (default 6 for zip/tar.gz, 3 for tar.zst)', default=None)
+    parser.add_argument('--archive-workers', metavar='archive-workers', type=int, help=f'threads compressing the archive', default=os.cpu_count())
+    parser.add_argument('--scan-workers', metavar='scan-workers', type=int, help=f'threads scanning the top-level directories in parallel', default=4)
+    parser.add_argument('--stream', action='count', help=f'compress while uploading, without a local archive file', default=0)
+    parser.add_argument('--resume', action='count', help=f'continue an interrupted multipart upload of the same file from its journal', default=0)
+    parser.add_argument('--incremental', action='count', help=f'only upload the files and appended bytes changed since the last upload', default=0)
+    parser.add_argument('--manifest', metavar='manifest', type=str, help=f'local manifest of --incremental (default ~/.sendme_log/<network>-<name>.manifest.json)', default=None)
+    parser.add_argument('--max-concurrency', metavar='max-concurrency', type=int, help=f'upper bound of concurrent part uploads', default=16)
+    parser.add_argument('--bandwidth-limit', metavar='bandwidth-limit', type=float, help=f'limit upload bandwidth (MB/s)', default=None)
+    parser.add_argument('--race', metavar='race', type=int, help=f'race the upload to the N fastest regions and keep the fastest (2-3)', default=0)
+    parser.add_argument('--race-seconds', metavar='race-seconds', type=float, help=f'length of the region race', default=5)
+    parser.add_argument('--race-endpoints', metavar='race-endpoints', type=str, nargs="+", help=f'race S3 compatible endpoints instead of regions, URL or URL=MB/s to inject a bandwidth limit', default=None)
+    parser.add_argument('--endpoint-url', metavar='endpoint-url', type=str, help=f'S3 endpoint url (S3 compatible storage)', default=None)
     parser.add_argument('-r', '--region', metavar="region", type=str, help=f'region ', default=None)
     return parser
 
@@ -428,6 +1628,11 @@ def main():
         dump(find_fastest_region())
         raise SystemExit()
 
+    if args.archive_format == "tar.zst" and zstandard is None and not shutil.which("zstd"):
+        cprint(f"[ERROR] --archive-format tar.zst needs the 'zstandard' package (pip3 install zstandard) "
+               f"or the zstd command", "red")
+        raise SystemExit()
+
     if args.log_dir:
         if checkFileType(args.log_dir) == "dir":
             latest_log_dir = args.log_dir
@@ -436,9 +1641,9 @@ def main():
             cprint(f"[ERROR] '{args.log_dir}' is not directory", "red")
             raise SystemExit()
         if args.include_dir:
-            log_dir = sorted_key(SearchDir().setExcludePath(exclude_dir).setType("dir").find(), "unixtime")
+            log_dir = sorted_key(SearchDir().setExcludePath(exclude_dir).setType("dir").setWorkers(args.scan_workers).find(), "unixtime")
     else:
-        log_dir = sorted_key(SearchDir().setExcludePath(exclude_dir).setType("dir").find(), "unixtime")
+        log_dir = sorted_key(SearchDir().setExcludePath(exclude_dir).setType("dir").setWorkers(args.scan_workers).find(), "unixtime")
         # dump(log_dir)
         try:
             latest_log_dir = log_dir[0].get("full_filename")
@@ -448,47 +1653,21 @@ def main():
             dump(log_dir)
             raise SystemExit()
 
-    logfiles = SearchDir().setType("file").setPath(latest_log_dir).find()
+    selector = FileSelector(args.target_date, args.since, args.between, exclude_dir)
+    logfiles = SearchDir().setType("file").setPath(latest_log_dir).setSelector(selector).setWorkers(args.scan_workers).find()
 
     kvPrint("Your log directory", f'{latest_log_dir} \t\t[{latest_log_modify}]')
-    kvPrint("Target date", args.target_date)
+    kvPrint("Target date", selector.label)
     kvPrint("Excluding directory", exclude_dir)
-    cprint(f"\n---------- Found log files ({args.target_date})  ----------", "white")
+    cprint(f"\n---------- Found log files ({selector.label})  ----------", "white")
 
-    today = datetime.datetime.today().strftime("%Y-%m-%d")
+    today = datetime.date.today()
     today_time = datetime.datetime.today().strftime("%Y%m%d_%H%M%S")
 
     target_filenames = []
-    file_count = 0
-
-    for k, file in enumerate(logfiles):
-        date = file['date'].strftime("%Y-%m-%d")
-        diff_date = datetime.datetime.strptime(
-            today, "%Y-%m-%d") - datetime.datetime.strptime(date, "%Y-%m-%d")
-
-        exclude_match = False
-        for exclude in exclude_dir:
-            if file['full_filename'].count(exclude) > 0:  # not match
-                exclude_match = True
-            if exclude_match is True:
-                break
-
-        if exclude_match is False:
-            if args.target_date == "today":
-                # if today == date:
-                if diff_date.days <= 1:
-                    file_count = file_count + 1
-                    target_filenames.append(file['full_filename'])
-                    print(f"[{file_count}] today :: {file['full_filename']:40}  {file['size']:10} {file['date']} ({diff_date.days})")
-            elif args.target_date == "all":
-                file_count = file_count + 1
-                target_filenames.append(file['full_filename'])
-                print(f"[{file_count}] all :: {file['full_filename']:70}  {file['size']:10} {file['date']} ({diff_date.days})")
-            else:
-                if args.target_date == date:
-                    file_count = file_count + 1
-                    target_filenames.append(file['full_filename'])
-                    print(f"[{file_count}] [{args.target_date}] :: {file['full_filename']:70}  {file['size']:10} {file['date']} ({diff_date.days})")
+    for file_count, file in enumerate(logfiles, 1):
+        target_filenames.append(file['full_filename'])
+        print(f"[{file_count}] {selector.label} :: {file['full_filename']:70}  {file['size']:10} {file['date']} ({(today - file['date'].date()).days})")
 
     cprint("---------------------------------------------\n", "white")
     if len(target_filenames) == 0:
@@ -505,7 +1684,7 @@ def main():
     if len(myip) > 50:  # TODO ip 가져올때 예외 처리 하기
         myip = "NULL"
 
-    upload_filename = f"{name}-{myip}-{today_time}.zip"
+    upload_filename = f"{name}-{myip}-{today_time}.{archive_extensions[args.archive_format]}"
 
     if len(name) == 0:
         cprint(f'[ERR] need a your prep-node name', "red")
@@ -520,7 +1699,33 @@ def main():
     #     target_filenames = sorted_key(SearchDir().setPath(args.dir).setExcludePath(exclude_dir).setType("dir").find(), "unixtime")
     #
 
-    if args.static_dir:
+    archive_entries = target_filenames
+    if args.incremental:
+        if args.static_dir or args.upload_filename:
+            cprint(f"[ERROR] --incremental archives the found log files, not --static-dir or --upload-filename", "red")
+            raise SystemExit()
+        manifest = UploadManifest(args.manifest or UploadManifest.default_path(args.network, name))
+        archive_entries, file_states = manifest.plan(target_filenames)
+        if len(archive_entries) == 0:
+            if file_states:
+                manifest.commit(None, file_states)
+            cprint(f"[OK] Nothing changed since the last upload ({manifest.path})", "green")
+            raise SystemExit()
+        kvPrint("Incremental", f"{sizeof_fmt(archive_input_size(archive_entries))} of "
+                               f"{sizeof_fmt(sum(os.path.getsize(filename) for filename in target_filenames))} changed, "
+                               f"{len(archive_entries)}/{len(target_filenames)} files")
+
+    if args.stream:
+        if args.static_dir or args.upload_filename:
+            cprint(f"[ERROR] --stream archives the found log files, not --static-dir or --upload-filename", "red")
+            raise SystemExit()
+        if args.resume:
+            cprint(f"[ERROR] --stream uploads cannot be resumed, use --resume without --stream", "red")
+            raise SystemExit()
+        if args.race > 1 or args.race_endpoints:
+            cprint(f"[ERROR] --stream uploads cannot race regions, use --race without --stream", "red")
+            raise SystemExit()
+    elif args.static_dir:
         dir_string = ""
         for dir in args.static_dir:
             dir_string = f"{dir_string} {dir}"
@@ -530,11 +1735,15 @@ def main():
     elif args.upload_filename:
         upload_filename = args.upload_filename
     else:
-        archive_zip2(target_filenames, f"{upload_filename}")
+        archive_files(archive_entries, f"{upload_filename}", args.archive_format, args.compress_level, args.archive_workers)
 
-    # upload_filesize = sizeof_fmt(os.stat(upload_filename).st_size)
-    upload_filesize = get_file_info(upload_filename).get("size")
-    cprint(f'>> upload target: {args.network}/{upload_filename}, size: {upload_filesize}')
+    if args.stream:
+        upload_filesize = sizeof_fmt(archive_input_size(archive_entries))
+        cprint(f'>> upload target: {args.network}/{upload_filename}, streaming {upload_filesize} before compression')
+    else:
+        # upload_filesize = sizeof_fmt(os.stat(upload_filename).st_size)
+        upload_filesize = get_file_info(upload_filename).get("size")
+        cprint(f'>> upload target: {args.network}/{upload_filename}, size: {upload_filesize}')
 
     if args.upload:
         answer = "y"
@@ -542,17 +1751,43 @@ def main():
         answer = input("\n Are you going to upload it? It will be send to ICONLOOP's S3 (y/n)")
 
     if answer == "y":
-        if args.region:
-            cprint(f"region => {args.region}", "green")
-            region = {'url': f'https://icon-leveldb-backup.{region_info.get(args.region)}.amazonaws.com/route_check', 'time': 0, 'name': args.region,
-                      'text': 'OK\n', 'status': 200}
+        bandwidth_limit = args.bandwidth_limit * 1024 * 1024 if args.bandwidth_limit else None
+        endpoint_url = args.endpoint_url
+        if args.race > 1 or args.race_endpoints:
+            candidates = race_candidates(args.race, args.race_endpoints)
+            bucket_code, endpoint_url = race_upload_with_s3(f"{upload_filename}", f"{args.network}/{upload_filename}", candidates,
+                                                            args.race_seconds, args.max_concurrency, bandwidth_limit)
         else:
-            region = find_fastest_region()
+            if args.region:
+                cprint(f"region => {args.region}", "green")
+                region = {'url': f'https://icon-leveldb-backup.{region_info.get(args.region)}.amazonaws.com/route_check', 'time': 0, 'name': args.region,
+                          'text': 'OK\n', 'status': 200}
+            else:
+                region = find_fastest_region()
 
-        bucket_code = (region_info.get(region.get("name")).split("."))[0]
-        cprint(f'[OK] Fastest region -> {region.get("name")}', "green")
-        kvPrint(f'bucket_code', bucket_code) if args.verbose else False
-        multi_part_upload_with_s3(f"{upload_filename}", f"{args.network}/{upload_filename}", bucket_code, args.upload_type)
+            bucket_code = (region_info.get(region.get("name")).split("."))[0]
+            cprint(f'[OK] Fastest region -> {region.get("name")}', "green")
+            kvPrint(f'bucket_code', bucket_code) if args.verbose else False
+            if args.stream:
+                transfer_size = archive_input_size(archive_entries)
+            else:
+                transfer_size = os.path.getsize(upload_filename)
+            planner = TransferPlanner(transfer_size, max_concurrency=args.max_concurrency, bandwidth_limit=bandwidth_limit)
+            if args.stream:
+                stream_upload_archive(archive_entries, f"{args.network}/{upload_filename}", bucket_code,
+                                      args.archive_format, args.compress_level, args.archive_workers, endpoint_url, planner)
+            elif args.resume or args.upload_type == "multi":
+                resumable_upload_with_s3(f"{upload_filename}", f"{args.network}/{upload_filename}", bucket_code, endpoint_url,
+                                         args.resume, planner)
+            else:
+                multi_part_upload_with_s3(f"{upload_filename}", f"{args.network}/{upload_filename}", bucket_code, args.upload_type,
+                                          endpoint_url)
+        if args.incremental:
+            manifest_key = f"{args.network}/{upload_filename}.manifest.json"
+            upload_manifest_object(manifest.remote_manifest(f"{args.network}/{upload_filename}", file_states), manifest_key,
+                                   bucket_code, endpoint_url)
+            manifest.commit(f"{args.network}/{upload_filename}", file_states)
+            kvPrint("Manifest", manifest_key)
         cprint(f"\n[OK] File uploaded successfully", "green")
     else:
         cprint(f"\n Stopped", "red")
@@ -570,10 +1805,6 @@ def banner():
     print("=" * 57)
 
 
-# for i in range( 1, 10000000):
-#     ProgressPercentage("data/loopchain/log/dummy.file").__call__(i)
-# raise SystemExit
-
 if __name__ == '__main__':
     global args, exclude_dir, encode_key, aawwss_text, aawwss_env
     encode_key = b"ZhiS-yXbkk_KPbGkqIw85FX2aHRhSBrG-yVOQiTiZeg="
@@ -602,7 +1833,9 @@ if __name__ == '__main__':
         cprint("\nKeyboardInterrupt", "green")
         pass
     finally:
-        if upload_filename is not None and os.path.isfile(upload_filename) and args.remove:
+        if upload_filename is not None and os.path.isfile(f"{upload_filename}.upload.json"):
+            cprint(f'Keep {upload_filename} to resume the upload', "yellow")
+        elif upload_filename is not None and os.path.isfile(upload_filename) and args.remove:
             print(f'Remove temporary zip file -> {upload_filename}')
             os.remove(upload_filename)
 
@@ -3,8 +3,16 @@
 import time, sys
 import subprocess, argparse
 import select
+import mmap
+import collections
+import multiprocessing
+import threading
+import atexit
+import hashlib
+import queue
 import json
 import requests
+from multiple_parser import expand_logfiles, merge_logfiles, open_logfile, detect_compression, ThroughputStats
 
 import os, string, re, signal, errno
 
@@ -89,7 +97,7 @@ def get_colour(x):
         raise ValueError('Bad colour specified: ' + x)
 
 
-def kvPrint(key, value, color="yellow"):
+def kvPrint(key, value, color="yellow", output=sys.stdout):
     class bcolors:
         HEADER = '\033[95m'
         OKBLUE = '\033[94m'
@@ -103,8 +111,8 @@ def kvPrint(key, value, color="yellow"):
     key_width = 9
     key_value = 3
 
-    print(bcolors.OKGREEN + "{:>{key_width}} : ".format(key, key_width=key_width) + bcolors.ENDC, end="")
-    print(bcolors.WARNING + "{:>{key_value}} ".format(str(value), key_value=key_value) + bcolors.ENDC)
+    print(bcolors.OKGREEN + "{:>{key_width}} : ".format(key, key_width=key_width) + bcolors.ENDC, end="", file=output)
+    print(bcolors.WARNING + "{:>{key_value}} ".format(str(value), key_value=key_value) + bcolors.ENDC, file=output)
 
 
 def genParam(method, params=None):
@@ -128,7 +136,7 @@ def genParam(method, params=None):
     return payload
 
 
-def post(url, payload, elapsed=False):
+def post(url, payload, elapsed=False, output=sys.stdout):
 
     if not re.search('^http', url):
         url = f"http://{url}"
@@ -137,17 +145,17 @@ def post(url, payload, elapsed=False):
     try:
         data = requests.post(url, json=payload, verify=False, timeout=5)
     except requests.exceptions.HTTPError as errh:
-        kvPrint("Http Error:", errh)
+        kvPrint("Http Error:", errh, output=output)
     except requests.exceptions.ConnectionError as errc:
-        kvPrint("Error Connecting:", errc)
+        kvPrint("Error Connecting:", errc, output=output)
     except requests.exceptions.Timeout as errt:
-        kvPrint("Timeout Error:", errt)
+        kvPrint("Timeout Error:", errt, output=output)
     except requests.exceptions.RequestException as err:
-        kvPrint("OOps: Something Else", err)
+        kvPrint("OOps: Something Else", err, output=output)
 
     if data is not None:
         if data.status_code > 200:
-            print(f"status_code: {data.status_code} , url: {url} , payload: {payload}")
+            print(f"status_code: {data.status_code} , url: {url} , payload: {payload}", file=output)
         if elapsed and data.status_code:
             return {"data": data, "elapsed": data.elapsed.total_seconds()}
         else:
@@ -161,11 +169,21 @@ def get_parser():
     parser.add_argument('--url', metavar='url', help=f'loopchain API URL', default="http://localhost:9000")
     parser.add_argument('--conf', metavar='conf', help=f'configure file', default=None)
     parser.add_argument('-c', '--color', action='count', help=f'show colorful logging ', default=0)
-    parser.add_argument('--logfile', metavar='logfile', help=f'log file', default="/app/prep/data/loopchain/log/loopchain.channel.icon_dex.log")
+    parser.add_argument('--logfile', metavar='logfile', nargs='+', help=f'log files, several files are merged by timestamp in cat', default=["/app/prep/data/loopchain/log/loopchain.channel.icon_dex.log"])
+    parser.add_argument('-r', '--rotated', action='store_true', help=f'include the rotated .1, .2, .gz siblings of each log file (cat)')
+    parser.add_argument('--rule-file', metavar='rule-file', help=f'grcat style colour rule file instead of the built-in rules', default=None)
+    parser.add_argument('--cache-file', metavar='cache-file', help=f'P-Rep name cache file (default ~/.cache/tailoop/preps-<url>.json)', default=None)
+    parser.add_argument('--cache-ttl', metavar='cache-ttl', type=int, help=f'seconds a cached P-Rep list is used without asking the node, 0 = no cache', default=3600)
+    parser.add_argument('--refresh-interval', metavar='refresh-interval', type=int, help=f'seconds between P-Rep list refreshes in tail mode, 0 = never', default=600)
+    parser.add_argument('-w', '--workers', metavar='workers', type=int, help=f'number of processes for cat, 0 = number of CPUs', default=1)
+    parser.add_argument('--stats', action='store_true', help=f'report throughput, section times and per-rule match counts and regex times on stderr')
+    parser.add_argument('--stats-json', metavar='stats-json', help=f'also write every stats report to this JSON file (implies --stats)', default=None)
+    parser.add_argument('--stats-interval', metavar='stats-interval', type=int, help=f'seconds between stats reports, 0 = only at the end', default=10)
+    parser.add_argument('-n', '--lines', metavar='lines', type=int, help=f'output the last N lines when starting tail', default=10)
     return parser
 
 
-def getNameByaddress():
+def getNameByaddress(output=sys.stdout):
     return_result = {}
 
     if args.conf:
@@ -182,7 +200,7 @@ def getNameByaddress():
     else:
         payload = genParam("getPReps")
         response = post(
-            f"{args.url}/api/v3", payload=payload)
+            f"{args.url}/api/v3", payload=payload, output=output)
         return_result = {}
         if response:
             prep_list = response.json().get("result").get("preps")
@@ -195,6 +213,94 @@ def getNameByaddress():
     return return_result
 
 
+def get_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "tailoop")
+
+
+def write_json_atomic(filename, data):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_file = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_file, filename)
+
+
+class PRepDirectory(object):
+    ''' address -> name map of the P-Reps, cached on disk.
+
+    `load()` uses the cache file when it is younger than `ttl` seconds and
+    does not touch the network at all. A stale cache is used as it is and
+    refreshed in the background, only a missing cache blocks on `fetch`.
+    `start_refresh()` keeps refreshing the map during long tail sessions,
+    so newly registered P-Reps show up without a restart. The current map
+    is always available as `index`.
+
+    `fetch(output)` writes its connection errors to `output`; refreshes in
+    the background pass stderr so they never mix with the tailed log, and
+    a failing refresh keeps the current map.
+    '''
+
+    def __init__(self, fetch, cache_file=None, ttl=3600):
+        self.fetch = fetch
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.index = AddressIndex({})
+
+    @staticmethod
+    def default_cache_file(url):
+        url_hash = hashlib.sha1(url.encode()).hexdigest()[:12]
+        return os.path.join(get_cache_dir(), f"preps-{url_hash}.json")
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            return cache['fetched_at'], cache['preps']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, None
+
+    def _write_cache(self, preps):
+        try:
+            write_json_atomic(self.cache_file, {"fetched_at": time.time(), "preps": preps})
+        except OSError as e:
+            sys.stderr.write(f"[WARN] Cannot write P-Rep cache {self.cache_file} - {e}\n")
+
+    def load(self):
+        if self.cache_file and self.ttl > 0:
+            fetched_at, preps = self._read_cache()
+            if preps:
+                self.index = AddressIndex(preps)
+                if time.time() - fetched_at > self.ttl:
+                    threading.Thread(target=self.refresh, args=(sys.stderr,), daemon=True).start()
+                return self
+        self.refresh()
+        return self
+
+    def refresh(self, output=sys.stdout):
+        try:
+            preps = self.fetch(output)
+        except Exception as e:
+            sys.stderr.write(f"[WARN] Cannot refresh the P-Rep list - {e!r}\n")
+            return False
+        if not preps:
+            return False
+        if self.cache_file and self.ttl > 0:
+            self._write_cache(preps)
+        self.index = AddressIndex(preps)
+        return True
+
+    def start_refresh(self, interval=600):
+        def _loop():
+            while True:
+                time.sleep(interval)
+                self.refresh(sys.stderr)
+
+        thread = threading.Thread(target=_loop, daemon=True)
+        thread.start()
+        return thread
+
+
 def openJson(filename):
     try:
         json_data = open(filename).read()
@@ -222,12 +328,50 @@ def file_exist(filename):
     return True
 
 
-def changeMatchString(line, prep_address):
+class AddressIndex(object):
+    ''' address -> name map compiled into a single regular expression.
 
-    for prep_hash in prep_address:
-        if prep_hash in line:
-            line = line.replace(prep_hash, f">> {prep_address[prep_hash]} << ({prep_hash}) ")
-    return line
+    Every P-Rep address has the `hx` + 40 hex shape, so one scan for that
+    shape and a dict lookup per hit replaces all of them, no matter how
+    many P-Reps are registered. Addresses of another shape (from a --conf
+    file) are added to the expression as literal alternatives.
+    '''
+    address_shape = r'hx[0-9a-fA-F]{40}'
+
+    def __init__(self, prep_address):
+        self.replacements = {
+            address: f">> {name} << ({address}) " for address, name in prep_address.items() if address
+        }
+        others = sorted(
+            [re.escape(address) for address in self.replacements if not re.fullmatch(self.address_shape, address)],
+            key=len, reverse=True
+        )
+        self.pattern = re.compile("|".join(others + [self.address_shape]))
+        self.prefix = "hx" if not others else None
+
+    def __len__(self):
+        return len(self.replacements)
+
+    def _lookup(self, m):
+        return self.replacements.get(m.group(0), m.group(0))
+
+    def replace(self, line):
+        if not self.replacements or (self.prefix and self.prefix not in line):
+            return line
+        return self.pattern.sub(self._lookup, line)
+
+
+_address_indexes = {}
+
+
+def changeMatchString(line, prep_address):
+    if not isinstance(prep_address, AddressIndex):
+        # compile a plain dict once, the dict is kept so its id is not reused
+        cached = _address_indexes.get(id(prep_address))
+        if cached is None or cached[0] is not prep_address or cached[1] != len(prep_address):
+            cached = _address_indexes[id(prep_address)] = (prep_address, len(prep_address), AddressIndex(prep_address))
+        prep_address = cached[2]
+    return prep_address.replace(line)
 
 
 def getREGEX(data):
@@ -287,19 +431,66 @@ def getREGEX(data):
                 # cs = ll['count']
                 if keyword == "count":
                     continue
-                if 'colours' in ll:
+                # convert only the keyword just read, so keywords may come in any order
+                if keyword == 'colours':
 
                     colstrings = list(
                         [''.join([get_colour(x) for x in split(colgroup)]) for colgroup in split(ll['colours'], ',')]
                     )
                     ll['colours'] = colstrings
 
-                elif 'regexp' in ll:
+                elif keyword == 'regexp':
                     if ll.get("regexp", None) :
                         ll['regexp'] = re.compile(ll['regexp']).search
 
     return regexplist
 
+RULE_CACHE_VERSION = 1
+
+
+def load_rules(data, source="builtin", cache_dir=None):
+    ''' getREGEX() with the parsed rule list cached on disk.
+
+    The cache file of a rule source stores the hash of the rule text it was
+    built from, so editing the rules invalidates it automatically. Regular
+    expressions are stored as their pattern and flags; compiled patterns
+    cannot be shared between processes, so only re.compile() is left on
+    a cache hit.
+    '''
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    source_hash = hashlib.sha1(source.encode()).hexdigest()[:12]
+    cache_file = os.path.join(cache_dir, f"rules-{source_hash}.json")
+    rule_hash = hashlib.sha256(f"{RULE_CACHE_VERSION}\n{data}".encode()).hexdigest()
+
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if cache.get("hash") == rule_hash:
+            regexplist = []
+            for rule in cache['rules']:
+                if isinstance(rule.get('regexp'), dict):
+                    rule['regexp'] = re.compile(rule['regexp']['pattern'], rule['regexp']['flags']).search
+                regexplist.append(rule)
+            return regexplist
+    except (OSError, ValueError, KeyError, TypeError, re.error):
+        pass
+
+    regexplist = getREGEX(data)
+    rules = []
+    for pattern in regexplist:
+        rule = dict(pattern)
+        if callable(rule.get('regexp')):
+            compiled = rule['regexp'].__self__
+            rule['regexp'] = {"pattern": compiled.pattern, "flags": compiled.flags}
+        rules.append(rule)
+    try:
+        write_json_atomic(cache_file, {"hash": rule_hash, "source": source, "rules": rules})
+    except (OSError, TypeError) as e:
+        sys.stderr.write(f"[WARN] Cannot write rule cache {cache_file} - {e}\n")
+    return regexplist
+
+
 def classdump(obj):
     class bcolors:
         HEADER = '\033[95m'
@@ -320,17 +511,165 @@ def classdump(obj):
 class GetOutOfLoop( Exception ):
     pass
 
-def colorizing(line, regexplist):
-    prevcolour = colours['default']
-    prevcount = "more"
-    blockflag = 0
-    clist = []
-    skip = 0
-
-    for pattern in regexplist:
-        pos = 0
-        currcount = pattern.get('count')
-        if currcount:
+class ActionQueue(object):
+    ''' Runs the `concat` and `command` actions of the rules in a background
+        thread, so rendering never waits for the disk or a child process.
+
+    Actions go through a bounded queue. A concat line waits for room when
+    it is full, so no line is lost, while a command is dropped (and counted).
+    concat targets stay open with buffered writes that are flushed every
+    `flush_interval` seconds. A command is started without waiting for it,
+    is not queued again while a run of it is still pending, and runs at
+    most once per `command_interval` seconds. close() reports the dropped
+    and throttled commands on stderr.
+    '''
+
+    def __init__(self, maxsize=10000, flush_interval=1.0, command_interval=1.0):
+        self.flush_interval = flush_interval
+        self.command_interval = command_interval
+        self.dropped = 0
+        self.throttled = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._files = {}
+        self._children = []
+        self._last_run = {}
+        self._pending_commands = set()
+
+    def concat(self, filename, line):
+        self._put(("concat", filename, line), block=True)
+
+    def command(self, command):
+        if command in self._pending_commands:
+            self.throttled += 1
+            return
+        self._pending_commands.add(command)
+        if not self._put(("command", command)):
+            self._pending_commands.discard(command)
+
+    def replay(self, actions):
+        for action in actions:
+            getattr(self, action[0])(*action[1:])
+
+    def _put(self, item, block=False):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put(item, block)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                try:
+                    getattr(self, f"_do_{item[0]}")(*item[1:])
+                except OSError as e:
+                    sys.stderr.write(f"[WARN] {item[0]} action failed - {e}\n")
+            if time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + self.flush_interval
+        self._flush()
+
+    def _do_concat(self, filename, line):
+        f = self._files.get(filename)
+        if f is None:
+            f = self._files[filename] = open(filename, 'a', buffering=64 * 1024)
+        f.write(line + '\n')
+
+    def _do_command(self, command):
+        self._pending_commands.discard(command)
+        now = time.monotonic()
+        if now - self._last_run.get(command, -self.command_interval) < self.command_interval:
+            self.throttled += 1
+            return
+        self._last_run[command] = now
+        self._children.append(subprocess.Popen(command, shell=True))
+
+    def _flush(self):
+        for f in self._files.values():
+            f.flush()
+        self._children = [child for child in self._children if child.poll() is None]
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        if self.dropped or self.throttled:
+            sys.stderr.write(f"[WARN] command actions: {self.dropped} dropped (queue full), {self.throttled} throttled\n")
+            self.dropped = self.throttled = 0
+
+
+class ActionCollector(list):
+    ''' Records actions instead of running them, used by the cat workers
+        so that the parent runs them in file order.
+    '''
+
+    def concat(self, filename, line):
+        self.append(("concat", filename, line))
+
+    def command(self, command):
+        self.append(("command", command))
+
+
+class Colorizer(object):
+    ''' Rule list from getREGEX() compiled into a span based renderer.
+
+    The matching part follows the grcat semantics of the rules (count
+    more/once/stop/block/unblock/previous, replace, concat, command, skip).
+    Instead of keeping a colour per character and concatenating the line
+    one character at a time, the collected colour intervals are painted
+    onto the few boundaries they produce and the line is emitted as slices,
+    so the cost of a line depends on the number of matches only.
+    '''
+
+    def __init__(self, regexplist, actions=None):
+        self.regexplist = regexplist
+        self.rules = [pattern for pattern in regexplist if pattern.get('count')]
+        self.actions = actions if actions is not None else ActionQueue()
+
+    def enable_stats(self, stats):
+        ''' Times the matching and rendering sections and every rule '''
+        self.rules = [
+            dict(pattern, regexp=stats.timed_rule(f"#{index} {pattern['regexp'].__self__.pattern[:50]}", pattern['regexp']))
+            for index, pattern in enumerate(self.rules)
+        ]
+        self.colorize = stats.timed("match", self.colorize)
+        self._render = stats.timed("render", self._render)
+
+    def colorize(self, line):
+        ''' Returns the rendered line, "" when the line is skipped and None
+            when nothing has to be printed at all (empty line).
+        '''
+        default = colours['default']
+        prevcolour = default
+        render_prevcolour = default
+        prevcount = "more"
+        blockflag = 0
+        blockcolour = default
+        clist = []
+        skip = 0
+
+        if not self.rules:
+            return line
+
+        for pattern in self.rules:
+            pos = 0
+            currcount = pattern['count']
             if line == "":
                 return
             if line[-1] in '\r\n':
@@ -343,9 +682,6 @@ def colorizing(line, regexplist):
                 if m:
                     if 'replace' in pattern:
                         line = re.sub(m.re, pattern['replace'], line)
-                        # m = pattern['regexp'](line, pos)
-                        # if not m:
-                        #    break
                     if 'colours' in pattern:
                         if currcount == "block":
                             blockflag = 1
@@ -355,10 +691,10 @@ def colorizing(line, regexplist):
 
                         elif currcount == "unblock":
                             blockflag = 0
-                            blockcolour = colours['default']
+                            blockcolour = default
                             currcount = "stop"
 
-                        clist = add2list(clist, m, pattern['colours'])
+                        add2list(clist, m, pattern['colours'])
 
                         if currcount == "previous":
                             currcount = prevcount
@@ -369,7 +705,6 @@ def colorizing(line, regexplist):
                         if currcount == "more":
                             prevcount = "more"
                             newpos = m.end(0)
-                            # print(f"newpos={newpos}")
                             # special case, if the regexp matched but did not consume anything,
                             # advance the position by 1 to escape endless loop
                             if newpos == pos:
@@ -381,12 +716,11 @@ def colorizing(line, regexplist):
                             pos = len(line)
 
                     if 'concat' in pattern:
-                        with open(pattern['concat'], 'a') as f:
-                            f.write(line + '\n')
+                        self.actions.concat(pattern['concat'], line)
                         if 'colours' not in pattern:
                             keepinnerloop = False
                     if 'command' in pattern:
-                        os.system(pattern['command'])
+                        self.actions.command(pattern['command'])
                         if 'colours' not in pattern:
                             keepinnerloop = False
                     if 'skip' in pattern:
@@ -398,96 +732,574 @@ def colorizing(line, regexplist):
 
                 if m and currcount == "stop":
                     prevcount = "stop"
-                    keepinnerloop=False
-                # keepinnerloop = False
-                # print(m, keepinnerloop)
+                    keepinnerloop = False
 
             if len(clist) == 0:
-                prevcolour = colours['default']
-            first_char = 0
-            last_char = 0
-            length_line = len(line)
+                prevcolour = default
             if blockflag == 0:
-                cline = (length_line + 1) * [colours['default']]
-                for i in clist:
-                    # each position in the string has its own colour
-                    if i[2] == "prev":
-                        cline[i[0]:i[1]] = [colours['default'] + prevcolour] * (i[1] - i[0])
-                    elif i[2] != "unchanged":
-                        cline[i[0]:i[1]] = [colours['default'] + i[2]] * (i[1] - i[0])
-                    if i[0] == 0:
-                        first_char = 1
-                        if i[2] != "prev":
-                            prevcolour = i[2]
-                    if i[1] == length_line:
-                        last_char = 1
-                if first_char == 0 or last_char == 0:
-                    prevcolour = colours['default']
+                render_prevcolour = prevcolour
+                prevcolour = self._carry_prevcolour(clist, prevcolour, len(line))
+
+        if skip:
+            return ""
+        if blockflag:
+            return (blockcolour + line if line and blockcolour else line) + default
+        return self._render(line, clist, render_prevcolour)
+
+    @staticmethod
+    def _carry_prevcolour(clist, prevcolour, length_line):
+        ''' The colour of a match covering the whole line is what
+            "previous" refers to in the following rules.
+        '''
+        first_char = 0
+        last_char = 0
+        for start, end, colour in clist:
+            if start == 0:
+                first_char = 1
+                if colour != "prev":
+                    prevcolour = colour
+            if end == length_line:
+                last_char = 1
+        if first_char == 0 or last_char == 0:
+            prevcolour = colours['default']
+        return prevcolour
+
+    @staticmethod
+    def _render(line, clist, prevcolour):
+        default = colours['default']
+        length_line = len(line)
+        paints = []
+        for start, end, colour in clist:
+            # each interval has its own colour, the later one wins
+            if colour == "prev":
+                paint = default + prevcolour
+            elif colour != "unchanged":
+                paint = default + colour
             else:
-                cline = (length_line + 1) * [blockcolour]
-            nline = ""
-            clineprev = ""
-            if not skip:
-                # print(f"skip= {skip}")
-                for i in range(len(line)):
-                    if cline[i] == clineprev:
-                        nline = nline + line[i]
-                    else:
-                        nline = nline + cline[i] + line[i]
-                        clineprev = cline[i]
-                nline = nline + colours['default']
+                paint = None
+            if start == 0 and colour != "prev":
+                prevcolour = colour
+            if paint is None:
+                continue
+            start = min(start, length_line)
+            end = min(end, length_line)
+            if start < end:
+                paints.append((start, end, paint))
+
+        if not paints:
+            return (default + line if line else "") + default
+
+        bounds = sorted({0, length_line}.union(*[(start, end) for start, end, _ in paints]))
+        index = {bound: i for i, bound in enumerate(bounds)}
+        spans = [default] * (len(bounds) - 1)
+        for start, end, paint in paints:
+            spans[index[start]:index[end]] = [paint] * (index[end] - index[start])
+
+        nline = []
+        clineprev = ""
+        for i, colour in enumerate(spans):
+            if colour != clineprev:
+                nline.append(colour)
+                clineprev = colour
+            nline.append(line[bounds[i]:bounds[i + 1]])
+        nline.append(default)
+        return "".join(nline)
+
+
+_colorizers = {}
+
+
+def _close_colorizers():
+    for regexplist, colorizer in _colorizers.values():
+        colorizer.actions.close()
+    _colorizers.clear()
+
+
+atexit.register(_close_colorizers)
+
+
+def colorizing(line, regexplist):
+    if not isinstance(regexplist, Colorizer):
+        # one Colorizer (and action thread) per rule list, closed at exit so concat writes are flushed
+        cached = _colorizers.get(id(regexplist))
+        if cached is None or cached[0] is not regexplist:
+            cached = _colorizers[id(regexplist)] = (regexplist, Colorizer(regexplist))
+        regexplist = cached[1]
+    nline = regexplist.colorize(line)
+    if nline is None:
+        return
     try:
         print(nline)
     except IOError as e:
         print(f" Error : {e}")
 
 
+class Inotify(object):
+    ''' Minimal inotify(7) wrapper through ctypes. Watches the directory of
+        the log file, so that writes, truncation and rotation of the file
+        (rename + create) all wake up the follower.
+    '''
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, path):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | \
+            self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno_value = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno_value, f"inotify_add_watch failed - {path}")
+
+    def wait(self, timeout):
+        'Block until something happened in the directory or timeout expired'
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+        return bool(readable)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LogFollower(object):
+    ''' In-process replacement of `tail -F`.
+
+    Reads the log file in large chunks and drains everything available on
+    every wakeup. The file is tracked by (st_dev, st_ino) so that rotation
+    re-opens the new file from the beginning and truncation rewinds to the
+    start, like `tail -F` does. Wakeups come from inotify when available,
+    otherwise the file is polled every `poll_interval` seconds.
+
+    `follow()` yields lists of lines. An empty list is yielded when nothing
+    happened within `poll_interval`, so the caller gets a chance to do
+    periodic work.
+    '''
+
+    def __init__(self, filename, lines=10, chunk_size=1024 * 1024, poll_interval=0.05):
+        self.filename = filename
+        self.lines = lines
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self._fp = None
+        self._stat = None
+        self._pending = b""
+        self._waiter = None
+
+    def _open(self, seek_last_lines=False):
+        try:
+            fp = open(self.filename, "rb")
+        except OSError:
+            return False
+        if self._fp:
+            self._fp.close()
+        self._fp = fp
+        self._stat = os.fstat(fp.fileno())
+        self._pending = b""
+        if seek_last_lines:
+            self._seek_last_lines(self.lines)
+        return True
+
+    def _seek_last_lines(self, count):
+        end = self._fp.seek(0, os.SEEK_END)
+        position = end
+        found = 0
+        while position > 0 and found <= count:
+            block_size = min(self.chunk_size, position)
+            position -= block_size
+            self._fp.seek(position)
+            block = self._fp.read(block_size)
+            if position + block_size == end and block.endswith(b"\n"):
+                block = block[:-1]
+            index = len(block)
+            while found <= count:
+                index = block.rfind(b"\n", 0, index)
+                if index < 0:
+                    break
+                found += 1
+                if found == count:
+                    self._fp.seek(position + index + 1)
+                    return
+        self._fp.seek(0 if count else end)
+
+    def _split(self, data):
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        return [line.decode("utf-8", "replace").rstrip('\r\n') for line in lines]
+
+    def _flush_pending(self):
+        if self._pending:
+            pending, self._pending = self._pending, b""
+            return [pending.decode("utf-8", "replace").rstrip('\r\n')]
+        return []
+
+    def _check_file(self):
+        ''' Called at EOF. Returns lines left over from a rotated file,
+            or None when the file is unchanged.
+        '''
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        if self._fp is None:
+            if self._open():
+                sys.stderr.write(f"tailoop: '{self.filename}' has appeared;  following new file\n")
+                return []
+            return None
+        if (stat.st_dev, stat.st_ino) != (self._stat.st_dev, self._stat.st_ino):
+            leftover = self._flush_pending()
+            if self._open():
+                sys.stderr.write(f"tailoop: '{self.filename}' has been replaced;  following new file\n")
+                return leftover
+        elif stat.st_size < self._fp.tell():
+            sys.stderr.write(f"tailoop: {self.filename}: file truncated\n")
+            self._fp.seek(0)
+            self._pending = b""
+            return []
+        return None
+
+    def _wait(self):
+        if self._waiter is None:
+            try:
+                self._waiter = Inotify(os.path.dirname(os.path.abspath(self.filename)))
+            except (OSError, AttributeError):
+                self._waiter = False
+        if self._waiter:
+            self._waiter.wait(self.poll_interval)
+        else:
+            time.sleep(self.poll_interval)
+
+    def follow(self):
+        if not self._open(seek_last_lines=True):
+            sys.stderr.write(f"tailoop: cannot open '{self.filename}' for reading: No such file or directory\n")
+        try:
+            while True:
+                data = self._fp.read(self.chunk_size) if self._fp else b""
+                if data:
+                    yield self._split(data)
+                    continue
+                leftover = self._check_file()
+                if leftover is None:
+                    yield []
+                    self._wait()
+                elif leftover:
+                    yield leftover
+        finally:
+            if self._waiter:
+                self._waiter.close()
+            if self._fp:
+                self._fp.close()
+
+
+class OutputWriter(object):
+    ''' Output stage of tailoop.
+
+    Rendered lines are collected in a bounded buffer and written with a
+    single write per batch. With `flush_interval` set (follow mode) the
+    buffer is also flushed once the oldest pending line is that old, so
+    interactive use still sees lines immediately. When the reader of the
+    pipe goes away (`| head`, quitting `less`) the program exits quietly.
+    '''
+
+    def __init__(self, stream=None, max_bytes=256 * 1024, flush_interval=None):
+        self.stream = stream or sys.stdout
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._size = 0
+        self._deadline = None
+
+    def write_line(self, line):
+        self.write(line + "\n")
+
+    def write(self, text):
+        if not text:
+            return
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self.max_bytes:
+            self.flush()
+        elif self.flush_interval is not None and self._deadline is None:
+            self._deadline = time.monotonic() + self.flush_interval
+
+    def tick(self):
+        'Flush when the flush deadline has passed'
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            self.flush()
+
+    def flush(self):
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        self._deadline = None
+        try:
+            self.stream.flush()
+            if data:
+                raw = getattr(self.stream, "buffer", None)
+                if raw is not None:
+                    raw.write(data.encode(self.stream.encoding or "utf-8", self.stream.errors or "strict"))
+                    raw.flush()
+                else:
+                    self.stream.write(data)
+                    self.stream.flush()
+        except BrokenPipeError:
+            self.exit_on_broken_pipe(self.stream)
+
+    @staticmethod
+    def exit_on_broken_pipe(stream):
+        # Python flushes stdout on exit, point it to devnull to avoid another BrokenPipeError
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, stream.fileno())
+        sys.exit(1)
+
+
+def render_line(line, prep_address, colorizer):
+    ''' Returns the text printed for one log line, None when nothing is printed '''
+    if len(prep_address) > 0:
+        line = changeMatchString(line, prep_address)
+    if colorizer:
+        return colorizer.colorize(line)
+    return line
+
+
+def timed_render_line(stats, colorizer):
+    ''' render_line() with the address substitution and the colorizer timed by `stats` '''
+    address = stats.timed("address", changeMatchString)
+    if colorizer:
+        colorizer.enable_stats(stats)
+
+    def _render_line(line, prep_address, colorizer):
+        if len(prep_address) > 0:
+            line = address(line, prep_address)
+        if colorizer:
+            return colorizer.colorize(line)
+        return line
+    return _render_line
+
+
+_cat_worker = {}
+
+
+def _init_cat_worker(filename, prep_address, regexplist, stats=False):
+    if filename:
+        fp = open(filename, "rb")
+        _cat_worker['mmap'] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    _cat_worker['prep_address'] = prep_address
+    _cat_worker['colorizer'] = Colorizer(regexplist, ActionCollector()) if regexplist else False
+    _cat_worker['render'] = render_line
+    _cat_worker['stats'] = None
+    if stats:
+        _cat_worker['stats'] = ThroughputStats(0, timing=True)
+        _cat_worker['render'] = timed_render_line(_cat_worker['stats'], _cat_worker['colorizer'])
+
+
+def _render_chunk(span):
+    start, end = span
+    return _render_data(_cat_worker['mmap'][start:end])
+
+
+def _render_data(data):
+    text = data.decode("utf-8", "replace")
+    lines = text.split("\n")
+    if text.endswith("\n"):
+        lines.pop()
+    output = []
+    colorizer = _cat_worker['colorizer']
+    render = _cat_worker['render']
+    for line in lines:
+        nline = render(line.rstrip('\r\n'), _cat_worker['prep_address'], colorizer)
+        if nline is not None:
+            output.append(nline)
+    if output:
+        output.append("")
+    actions = []
+    if colorizer and colorizer.actions:
+        actions = list(colorizer.actions)
+        del colorizer.actions[:]
+    stats = _cat_worker['stats']
+    if stats:
+        stats.count(len(lines), len(data))
+        counters = stats.as_dict()
+        stats.reset()
+        return "\n".join(output), actions, counters
+    return "\n".join(output), actions, None
+
+
+def split_chunks(data, chunk_size):
+    ''' Newline aligned (start, end) offsets covering the whole buffer '''
+    size = len(data)
+    start = 0
+    while start < size:
+        end = start + chunk_size
+        if end >= size:
+            end = size
+        else:
+            newline = data.find(b"\n", end)
+            end = size if newline < 0 else newline + 1
+        yield start, end
+        start = end
+
+
+def read_chunks(fp, chunk_size):
+    ''' Newline aligned chunks of a stream '''
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            return
+        if not data.endswith(b"\n"):
+            data += fp.readline()
+        yield data
+
+
+def cat_parallel(filename, prep_address, colorizer, writer, workers=0, chunk_size=4 * 1024 * 1024, stats=None):
+    ''' `cat` mode over a process pool. The file is memory-mapped and split
+        into newline aligned chunks, every worker renders whole chunks and
+        the results are written in the original order. At most a few chunks
+        per worker are in flight, so memory stays bounded on huge files.
+        Compressed files can not be mapped, their decompressed chunks are
+        sent to the workers instead. With `stats` the workers time their
+        sections too and send the counters back with every chunk.
+    '''
+    workers = workers if workers > 0 else os.cpu_count()
+    if detect_compression(filename):
+        with open_logfile(filename) as fp:
+            _render_parallel(None, read_chunks(fp, chunk_size), _render_data,
+                             prep_address, colorizer, writer, workers, stats)
+        return
+    with open(filename, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    _render_parallel(filename, split_chunks(data, chunk_size), _render_chunk,
+                     prep_address, colorizer, writer, workers, stats)
+    data.close()
+
+
+def _render_parallel(filename, chunks, render, prep_address, colorizer, writer, workers, stats=None):
+    pending = collections.deque()
+    regexplist = colorizer.regexplist if colorizer else False
+
+    def _write_result(result):
+        text, actions, counters = result.get()
+        writer.write(text)
+        if actions:
+            colorizer.actions.replay(actions)
+        if counters:
+            stats.merge(counters)
+            stats.tick()
+
+    with multiprocessing.Pool(workers, _init_cat_worker, (filename, prep_address, regexplist, bool(stats))) as pool:
+        for chunk in chunks:
+            pending.append(pool.apply_async(render, (chunk,)))
+            if len(pending) >= workers * 4:
+                _write_result(pending.popleft())
+        while pending:
+            _write_result(pending.popleft())
+
 
 def main():
-    filename = args.logfile
-    prep_address = getNameByaddress()
-    file_exist(args.logfile)
+    logfiles = expand_logfiles(args.logfile, args.rotated and args.command == "cat")
+    filename = logfiles[0]
+    if args.command == "tail" and len(logfiles) > 1:
+        print("[ERROR] tail follows a single log file")
+        raise SystemExit(1)
+    if args.command == "tail" and os.path.exists(filename) and detect_compression(filename):
+        print(f"[ERROR] tail can not follow a compressed log file - {filename}")
+        raise SystemExit(1)
+    if args.conf:
+        cache_file = None
+    else:
+        cache_file = args.cache_file or PRepDirectory.default_cache_file(args.url)
+    directory = PRepDirectory(getNameByaddress, cache_file, args.cache_ttl).load()
+    prep_address = directory.index
+    for logfile in logfiles:
+        if not file_exist(logfile) and args.command == "cat":
+            raise SystemExit(1)
 
     print(f"args.url = {args.url}")
     if args.command is "tail":
         args.color = True
 
-    regexplist = getREGEX(REGEX_DATA) if args.color > 0 else False
+    if args.color > 0 and args.rule_file:
+        with open(args.rule_file) as f:
+            regexplist = Colorizer(load_rules(f.read(), source=os.path.abspath(args.rule_file)))
+    elif args.color > 0:
+        regexplist = Colorizer(load_rules(REGEX_DATA))
+    else:
+        regexplist = False
 
     # print(regexplist)
     if len(prep_address) == 0:
         print("[ERROR] peer_id dict not found")
         # raise SystemExit()
 
-    if args.command == "cat":
-        f = subprocess.Popen(['cat', filename],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        for line in f.stdout:
-            line = line.decode("utf-8").rstrip('\r\n')
-            if len(prep_address) > 0:
-                line = changeMatchString(line, prep_address)
-            if args.color > 0:
-                colorizing(line, regexplist)
-            else:
-                print(line)
-
-            # print(line.decode().strip())
-
-    elif args.command == "tail":
-        f = subprocess.Popen(['tail', '-F', filename],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p = select.poll()
-        p.register(f.stdout)
-
-        while True:
-            if p.poll(1):
-                readline = f.stdout.readline().decode("utf-8").rstrip('\r\n')
-                line = changeMatchString(readline, prep_address)
-                if args.color > 0:
-                    colorizing(line, regexplist)
-                else:
-                    print(line)
-            time.sleep(0.01)
+    writer = OutputWriter(flush_interval=0.05 if args.command == "tail" else None)
+    render = render_line
+    stats = None
+    if args.stats or args.stats_json:
+        stats = ThroughputStats(args.stats_interval, timing=True, json_file=args.stats_json)
+        writer.flush = stats.timed("output", writer.flush)
+        parallel = args.command == "cat" and len(logfiles) == 1 and args.workers != 1
+        if not parallel:
+            render = timed_render_line(stats, regexplist)
+    try:
+        if args.command == "cat" and len(logfiles) > 1:
+            records = merge_logfiles(logfiles)
+            if stats:
+                records = stats.timed_iter(records, "read")
+            for label, record in records:
+                for line in record:
+                    nline = render(line.rstrip('\r\n'), prep_address, regexplist)
+                    if nline is not None:
+                        writer.write_line(f"[{label}] {nline}" if nline else nline)
+                if stats:
+                    stats.count(len(record), sum(len(line.encode("utf-8")) for line in record))
+
+        elif args.command == "cat" and args.workers != 1:
+            cat_parallel(filename, prep_address, regexplist, writer, args.workers, stats=stats)
+
+        elif args.command == "cat":
+            with open_logfile(filename) as f:
+                for line in stats.wrap(f) if stats else f:
+                    line = line.decode("utf-8", "replace").rstrip('\r\n')
+                    nline = render(line, prep_address, regexplist)
+                    if nline is not None:
+                        writer.write_line(nline)
+
+        elif args.command == "tail":
+            if args.refresh_interval > 0 and not args.conf:
+                directory.start_refresh(args.refresh_interval)
+            follower = LogFollower(filename, lines=args.lines)
+            for lines in follower.follow():
+                prep_address = directory.index
+                for readline in lines:
+                    nline = render(readline, prep_address, regexplist)
+                    if nline is not None:
+                        writer.write_line(nline)
+                writer.tick()
+                if stats:
+                    stats.count(len(lines), sum(len(line.encode("utf-8")) + 1 for line in lines))
+    finally:
+        writer.flush()
+        if regexplist:
+            regexplist.actions.close()
+        if stats:
+            stats.report(rules=None)
 
 
 
@@ -599,4 +1411,7 @@ if __name__ == '__main__':
     parser = get_parser()
     args = parser.parse_args()
     print(args)
-    main()
+    try:
+        main()
+    except BrokenPipeError:
+        OutputWriter.exit_on_broken_pipe(sys.stdout)